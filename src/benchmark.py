@@ -0,0 +1,292 @@
+import concurrency
+
+import argparse, glob, json, os, statistics, subprocess, sys, threading, time
+from urllib import request as urlrequest
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def report(name, samples):
+    print(f"{name:<24} median {statistics.median(samples):8.3f}s   min {min(samples):8.3f}s   max {max(samples):8.3f}s")
+
+# Launches the app in a fresh interpreter each run, so nothing is warm in the OS or Python caches except files.
+def bench_startup(args):
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    launched, shown, ready = [], [], []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, 'main.py', '--startup-time'],
+            cwd=SRC_DIR, env=env, capture_output=True, text=True, check=True)
+        launched.append(time.perf_counter() - start)
+
+        times = dict(line.split() for line in proc.stdout.splitlines() if line.startswith(('window_shown', 'model_ready')))
+        shown.append(float(times['window_shown']))
+        ready.append(float(times['model_ready']))
+
+    report("window shown", shown)
+    report("model warm", ready)
+    report("process total", launched)
+
+def bench_threads(args):
+    print(f"cgroup cpu limit: {concurrency.cgroup_cpu_limit()}")
+    print(f"usable cpus:      {concurrency.usable_cpus()}")
+
+def default_images():
+    return sorted(glob.glob(os.path.join(SRC_DIR, 'imaging', '*.jpg')))
+
+# Times every stage of the page pipeline, one page at a time like the app does.
+def bench_pages(args):
+    from detection import DocUtils
+    import constants
+    import numpy as np
+    concurrency.budget().apply_opencv()
+
+    pipeline = None
+    if not args.no_ocr:
+        from ocr import OcrModel
+        pipeline = OcrModel().get()
+
+    stages = {'find_document': [], 'crop_document': [], 'text_mask': [], 'resized_final': []}
+    ocr_heights = []
+    # Tiled masks against the whole page mask, the detector's own output before tiling was added.
+    ious = []
+
+    def untiled_mask(crop):
+        constants.OCR_TILED = False
+        try:
+            return DocUtils.text_mask(crop, pipeline)
+        finally:
+            constants.OCR_TILED = True
+
+    def iou(a, b):
+        union = np.count_nonzero((a > 0) | (b > 0))
+        return np.count_nonzero((a > 0) & (b > 0))/union if union > 0 else 1.0
+    tiers: dict[str, list[float]] = {}
+
+    def timed(stage, fn, *fn_args, **fn_kwargs):
+        start = time.perf_counter()
+        result = fn(*fn_args, **fn_kwargs)
+        stages[stage].append(time.perf_counter() - start)
+        return result
+
+    for _ in range(args.repeat):
+        for path in args.images or default_images():
+            found = {}
+            orig, corner = timed('find_document', DocUtils.find_document, path, info=found)
+            tiers.setdefault(found['tier'], []).append(stages['find_document'][-1])
+            crop = timed('crop_document', DocUtils.crop_document, orig, corner)
+
+            mask = None
+            if pipeline is not None:
+                info = {}
+                mask = timed('text_mask', DocUtils.text_mask, crop, pipeline, info)
+                ocr_heights.append(info['ocr_height'])
+                glyph = 'n/a' if info['glyph_height'] is None else f"{info['glyph_height']:.1f}px"
+                tiles = ''
+                if 'tiles' in info:
+                    ious.append(iou(mask, untiled_mask(crop)))
+                    tiles = f"  text tiles {info['text_tiles']}/{info['tiles']}  mask IoU {ious[-1]:.3f}"
+                print(f"{os.path.basename(path):<24} glyph {glyph:<8} ocr height {info['ocr_height']}{tiles}")
+
+            timed('resized_final', DocUtils.resized_final, crop, mask, width=constants.SAVE_WIDTH)
+
+    for stage, samples in stages.items():
+        if len(samples) > 0:
+            report(stage, samples)
+    # 'none' means neither detector found the page and the whole photo was kept.
+    pages = sum(len(samples) for samples in tiers.values())
+    for tier, samples in sorted(tiers.items()):
+        print(f"{'tier ' + tier:<24} {len(samples)/pages*100:5.1f}% of pages, avg {statistics.mean(samples)*1000:8.2f}ms")
+    if len(ocr_heights) > 0:
+        print(f"{'avg ocr height':<24} {statistics.mean(ocr_heights):.0f}px (fixed was {constants.OCR_HEIGHT}px)")
+    if len(ious) > 0:
+        print(f"{'tiled mask IoU':<24} mean {statistics.mean(ious):.3f}   min {min(ious):.3f} (against OCR_TILED=False)")
+
+# Checks the single channel preprocessing against the original three channel one on the tuning corpus
+# (the annotated imaging/*.jpg plus synthetic pages), on the edge maps and on the corners the Hough detector
+# finds from them. Corner errors are against the known corners, in percent of the image diagonal.
+def bench_edges(args):
+    from detection import DocUtils
+    import constants, imutils, tuning
+    import cv2, numpy as np
+    concurrency.budget().apply_opencv()
+
+    # Share of one map's edge pixels within a pixel of an edge in the other.
+    def agreement(a, b):
+        near = cv2.dilate(b, np.ones((3,3), np.uint8))
+        return np.count_nonzero(a & near)/max(1, np.count_nonzero(a))
+
+    def hough_error(sample, mode):
+        constants.EDGE_CHANNEL = mode
+        image = sample.image
+        small = imutils.convenience.resize(image, height=constants.ANALYSIS_HEIGHT) if mode == 'color' \
+            else DocUtils.preprocessor().analysis_image(image)
+        corners = DocUtils.find_lines(small, lambda: None)
+        if corners is None:
+            return float('inf')
+        return tuning.corner_error(sample, np.multiply(corners, image.shape[0]/constants.ANALYSIS_HEIGHT))
+
+    default = constants.EDGE_CHANNEL
+    channel = default if default != 'color' else 'luma'
+    times = {'color': [], channel: []}
+    errors = {'color': [], channel: []}
+    print(f"{'page':<24} {'precision':>9} {'recall':>7} {'color error':>12} {channel + ' error':>12}")
+    try:
+        for sample in tuning.load_corpus(args.synthetic, args.seed):
+            constants.EDGE_CHANNEL = default
+            start = time.perf_counter()
+            legacy = DocUtils.legacy_edges(imutils.convenience.resize(sample.image, height=constants.ANALYSIS_HEIGHT))
+            times['color'].append(time.perf_counter() - start)
+
+            constants.EDGE_CHANNEL = channel
+            start = time.perf_counter()
+            preprocessor = DocUtils.preprocessor()
+            edges = preprocessor.edges(preprocessor.analysis_image(sample.image)).copy()
+            times[channel].append(time.perf_counter() - start)
+
+            for mode in errors:
+                errors[mode].append(hough_error(sample, mode))
+            print(f"{sample.name:<24} {agreement(edges, legacy):9.2f} {agreement(legacy, edges):7.2f} "
+                  f"{errors['color'][-1]:11.2f}% {errors[channel][-1]:11.2f}%")
+    finally:
+        constants.EDGE_CHANNEL = default
+
+    for mode, samples in times.items():
+        report(f"preprocess {mode}", samples)
+    worse = sum(new > old + 1 for old, new in zip(errors['color'], errors[channel]))
+    print(f"{channel} corners more than 1% worse than color on {worse} of {len(errors['color'])} pages, "
+          f"median error {statistics.median(errors['color']):.2f}% color, {statistics.median(errors[channel]):.2f}% {channel}")
+
+# A fixed rig simulated by one annotated photo whose corners move by up to --jitter pixels from page to page.
+# Compares a full perspective warp per page with reused remap maps, one page at a time and in parallel threads.
+def bench_warp(args):
+    from detection import DocUtils
+    from warping import remaps
+    import constants, random, tuning
+    import numpy as np
+    concurrency.budget().apply_opencv()
+
+    sample = next(sample for sample in tuning.load_corpus(0, args.seed) if sample.name == args.image)
+    rng = random.Random(args.seed)
+    pages = [(sample.image, sample.corners + np.array([[rng.uniform(-args.jitter, args.jitter) for _ in range(2)] for _ in range(4)],
+        dtype='float32')) for _ in range(args.pages)]
+
+    def run(name, remap, fn):
+        constants.REMAP_WARP = remap
+        remaps.clear()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<24} {elapsed:8.3f}s   {len(pages)/elapsed:6.2f} pages/s")
+
+    default = constants.REMAP_WARP
+    try:
+        run('warpPerspective', False, lambda: [DocUtils.crop_document(*page) for page in pages])
+        run('remap', True, lambda: [DocUtils.crop_document(*page) for page in pages])
+        run(f"remap x{concurrency.budget().tiles} threads", True, lambda: DocUtils.crop_documents(pages))
+    finally:
+        constants.REMAP_WARP = default
+    print(f"{'remap cache':<24} {remaps.stats()}")
+
+def http(url, data=None, method=None, content_type='application/json'):
+    req = urlrequest.Request(url, data=data, method=method)
+    if data is not None:
+        req.add_header('Content-Type', content_type)
+    with urlrequest.urlopen(req) as response:
+        return response.read()
+
+# Several clients upload pages at once, then the pages are compiled into one PDF.
+# Without --url a service is started in this process on a free localhost port.
+def bench_service(args):
+    url = args.url
+    if url is None:
+        from service import Service, make_server
+        concurrency.budget().apply_opencv()
+        server = make_server('127.0.0.1', 0, Service())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+
+    images = [open(path, 'rb').read() for path in default_images()]
+    uploads = [images[i % len(images)] for i in range(args.pages)]
+
+    ids = [None]*len(uploads)
+    latency = [0.0]*len(uploads)
+
+    def client(index):
+        for id in range(index, len(uploads), args.clients):
+            start = time.perf_counter()
+            ids[id] = json.loads(http(f"{url}/pages", uploads[id], 'POST', 'application/octet-stream'))['id']
+            while True:
+                info = json.loads(http(f"{url}/pages/{ids[id]}"))
+                if info['status'] in ('done', 'error'):
+                    break
+                time.sleep(0.05)
+            latency[id] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    processed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pdf = http(f"{url}/compile", json.dumps({'pages': ids}).encode(), 'POST')
+    compiled = time.perf_counter() - start
+
+    # Nothing changed, so this should only be PDF assembly.
+    start = time.perf_counter()
+    http(f"{url}/compile", json.dumps({'pages': ids}).encode(), 'POST')
+    recompiled = time.perf_counter() - start
+
+    report("page round trip", latency)
+    print(f"{'pages processed':<24} {len(uploads)} in {processed:.3f}s, {len(uploads)/processed:.2f} pages/s")
+    print(f"{'compile':<24} {compiled:.3f}s, {len(pdf)} bytes")
+    print(f"{'recompile':<24} {recompiled:.3f}s")
+    for key, value in json.loads(http(f"{url}/stats")).items():
+        print(f"{'service ' + key:<28} {value:.3f}" if isinstance(value, float) else f"{'service ' + key:<28} {value}")
+
+if __name__ == '__main__':
+    concurrency.budget().apply_env()
+    parser = argparse.ArgumentParser(description="Timing tools for the Book Translate Tool pipeline.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    startup = commands.add_parser('startup', help="cold-start time to window shown and to model warm")
+    startup.add_argument('--runs', type=int, default=3)
+    startup.set_defaults(run=bench_startup)
+
+    threads = commands.add_parser('threads', help="show the detected cpu limits and per stage thread budget")
+    threads.set_defaults(run=bench_threads)
+
+    pages = commands.add_parser('pages', help="time each pipeline stage over a set of pages")
+    pages.add_argument('images', nargs='*', help="defaults to imaging/*.jpg")
+    pages.add_argument('--repeat', type=int, default=1)
+    pages.add_argument('--no-ocr', action='store_true', help="skip text detection, no model needed")
+    pages.set_defaults(run=bench_pages)
+
+    edges = commands.add_parser('edges', help="compare the single channel edge preprocessing with the original")
+    edges.add_argument('--synthetic', type=int, default=20, help="synthetic pages added to the annotated images")
+    edges.add_argument('--seed', type=int, default=0)
+    edges.set_defaults(run=bench_edges)
+
+    warp = commands.add_parser('warp', help="warp throughput on a simulated fixed rig")
+    warp.add_argument('--image', default='test2.jpg', help="annotated photo in imaging/ used for every page")
+    warp.add_argument('--pages', type=int, default=24)
+    warp.add_argument('--jitter', type=float, default=1.0, help="largest corner movement between pages, in pixels")
+    warp.add_argument('--seed', type=int, default=0)
+    warp.set_defaults(run=bench_warp)
+
+    service = commands.add_parser('service', help="queue latency and throughput of the HTTP service")
+    service.add_argument('--url', default=None, help="service to test, defaults to one started on localhost")
+    service.add_argument('--pages', type=int, default=12)
+    service.add_argument('--clients', type=int, default=3)
+    service.set_defaults(run=bench_service)
+
+    args = parser.parse_args()
+    import constants
+    if os.path.exists(constants.PROFILE_PATH):
+        print(f"Loaded profile: {constants.load_profile()}")
+    print(f"Thread budget: {concurrency.budget()}")
+    args.run(args)
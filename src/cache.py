@@ -0,0 +1,71 @@
+import constants
+
+import itertools, threading
+from collections import OrderedDict
+import numpy as np
+
+# Images derived from a page (the warped crop, finals rendered for saving), kept across jobs of one session.
+#
+# Keys start with the owner's id and include everything the image depends on (corners, mask version, size),
+# so an edit simply misses and the stale entry ages out. The total size is kept under a budget constant by
+# dropping the least recently used entries. Full resolution crops have their own small budget, so a
+# long batch of them can't push the compact finals out.
+
+class DerivativeCache(object):
+    def __init__(self, budget_name):
+        self._budget_name = budget_name
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+
+    # Read at use, so a loaded profile can still change it.
+    @property
+    def budget(self) -> int:
+        return getattr(constants, self._budget_name)
+
+    def new_owner(self) -> int:
+        return next(self._ids)
+
+    # render is called outside the lock, two threads missing on the same key both render it.
+    def get(self, key, render) -> np.ndarray:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        value = render()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value: np.ndarray):
+        if value.nbytes > self.budget:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key).nbytes
+            self._entries[key] = value
+            self.size += value.nbytes
+            while self.size > self.budget:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def discard(self, owner):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == owner]:
+                self.size -= self._entries.pop(key).nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+def derivative_key(owner, kind, corners, mask_version=None, height=None, width=None) -> tuple:
+    return owner, kind, np.asarray(corners, dtype='float32').tobytes(), mask_version, height, width
+
+derivatives = DerivativeCache('CACHE_BYTES')
+crops = DerivativeCache('CROP_CACHE_BYTES')
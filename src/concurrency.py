@@ -0,0 +1,96 @@
+import constants
+
+import math, os
+
+# Central thread budget for OpenCV, TensorFlow and our own pools.
+# Without it every library sizes itself to the whole machine and they fight over the same cores.
+
+def cgroup_cpu_limit():
+    # cgroup v2 exposes "quota period", v1 splits them over two files.
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+def usable_cpus() -> list[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def available_cpus() -> int:
+    override = os.environ.get(constants.THREADS_ENV)
+    if override:
+        return max(1, int(override))
+
+    cpus = len(usable_cpus())
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.floor(limit)))
+    return max(1, cpus)
+
+class ThreadBudget(object):
+    def __init__(self, cpus=None):
+        self.cpus = cpus or available_cpus()
+
+        # OCR runs one page at a time, so TensorFlow gets its share of the cores to itself
+        # and OpenCV (detection, warp, inpaint of the other jobs) gets the rest.
+        self.tf_intra = max(1, round(self.cpus*constants.OCR_CPU_SHARE))
+        self.tf_inter = 1
+        self.opencv = max(1, self.cpus - self.tf_intra)
+        # Always at least two jobs, otherwise an interactive recrop would wait behind a whole batch.
+        self.jobs = max(2, min(constants.JOB_THREADS, self.cpus))
+        self.tiles = max(1, min(constants.TILE_THREADS, self.opencv))
+
+    def __str__(self):
+        return (f"cpus={self.cpus} jobs={self.jobs} opencv={self.opencv} tiles={self.tiles} "
+                f"tf_intra={self.tf_intra} tf_inter={self.tf_inter}")
+
+    # Environment variables only work if they are set before numpy, cv2 and TensorFlow are imported.
+    def apply_env(self):
+        for name in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            os.environ.setdefault(name, str(self.opencv))
+        os.environ.setdefault('TF_NUM_INTRAOP_THREADS', str(self.tf_intra))
+        os.environ.setdefault('TF_NUM_INTEROP_THREADS', str(self.tf_inter))
+
+    def apply_opencv(self):
+        import cv2
+        cv2.setNumThreads(self.opencv)
+
+    # Must run before TensorFlow creates its runtime, i.e. before the first model is built.
+    def apply_tensorflow(self):
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(self.tf_intra)
+        tf.config.threading.set_inter_op_parallelism_threads(self.tf_inter)
+
+    # Splits the usable cores into count disjoint sets, for pinning worker processes.
+    def worker_cpus(self, index, count) -> list[int]:
+        cpus = usable_cpus()[:self.cpus]
+        share = max(1, len(cpus)//count)
+        start = (index*share) % len(cpus)
+        return cpus[start:start + share]
+
+def pin_process(cpus):
+    if hasattr(os, 'sched_setaffinity') and cpus:
+        os.sched_setaffinity(0, cpus)
+
+_budget = None
+
+def budget() -> ThreadBudget:
+    global _budget
+    if _budget is None:
+        _budget = ThreadBudget()
+    return _budget
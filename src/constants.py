@@ -1,16 +1,107 @@
-import numpy as np
+import json, os
+from math import pi
 
-ACCEPTABLE_FILES = ['png', 'jpg', 'jpeg']
+# Containers (see sources.py) hold several pages, archives are searched for IMAGE_FILES
+IMAGE_FILES = ['png', 'jpg', 'jpeg']
+CONTAINER_FILES = ['tif', 'tiff', 'zip', 'cbz', 'pdf']
+ACCEPTABLE_FILES = IMAGE_FILES + CONTAINER_FILES
 ACCEPTABLE_FILE_DIALOG = (''.join([f"*.{x} " for x in ACCEPTABLE_FILES]))[:-1]
 
-# Used in detection.py
+# Used in detection.py, EDGE_CHANNEL is 'luma', 'contrast' or 'color' (the original three channel preprocessing)
 CROP_RATIO = 1.545  
 RATIO_BASE      = 1.45
-RATIO_SIGMA     = 0.15
-THETA_THRESH    = np.pi/90
+RATIO_SIGMA     = 0.2
+THETA_THRESH    = pi/90
 RHO_THRESH      = 25
-LINE_THRESH     = 5*np.pi/45
+LINE_THRESH     = 5*pi/45
 CANNY_SIGMA     = 0.4
 RECTNESS_SIGMA  = 0.01
+ANALYSIS_HEIGHT = 600
+HOUGH_THRESH    = 60
+CONTOUR_MIN_AREA    = 0.2
+CONTOUR_EPSILON     = 0.02
+CONTOUR_CANDIDATES  = 3
+EDGE_CHANNEL        = 'luma'
+EDGE_SAMPLE_STEP    = 16
 
-SAVE_WIDTH = 1000
\ No newline at end of file
+SAVE_WIDTH = 1000
+
+# Used in detection.py, OCR_HEIGHT is the detector input height when the text size can't be estimated
+OCR_HEIGHT              = 1200
+OCR_MIN_HEIGHT          = 600
+OCR_MAX_HEIGHT          = 1680
+OCR_HEIGHT_STEP         = 120
+OCR_GLYPH_TARGET        = 12
+GLYPH_ANALYSIS_HEIGHT   = 800
+GLYPH_MIN_COMPONENTS    = 40
+
+# Used in detection.py, tiles are measured on the detector input and skipped without OCR_TILE_MIN_EDGES edge pixels
+# (Canny at the fixed OCR_TILE_EDGE thresholds) unless they hold OCR_TILE_MIN_GLYPHS letter shaped components
+OCR_TILED               = True
+OCR_TILE_SIZE           = 400
+OCR_TILE_OVERLAP        = 48
+OCR_TILE_BATCH          = 8
+OCR_TILE_FULL_PAGE      = 0.75
+OCR_TILE_EDGE_LOW       = 50
+OCR_TILE_EDGE_HIGH      = 150
+OCR_TILE_MIN_EDGES      = 24
+OCR_TILE_MIN_GLYPHS     = 3
+OCR_STITCH_OVERLAP      = 0.5
+
+# Used in pdf.py, same as PIL's default when it writes a PDF
+EXPORT_JPEG_QUALITY = 75
+
+# Used in tiling.py, pages at or above TILE_PIXELS are warped and inpainted in strips
+TILE_PIXELS         = 24_000_000
+TILE_MEMMAP_PIXELS  = 80_000_000
+TILE_HEIGHT         = 512
+TILE_OVERLAP        = 32
+TILE_THREADS        = 4
+
+# Used in warping.py, pages whose corners are all within REMAP_TOLERANCE pixels of a recent page reuse its remap maps,
+# built maps (6 bytes per output pixel) are kept under REMAP_CACHE_BYTES
+REMAP_WARP          = True
+REMAP_TOLERANCE     = 2.0
+REMAP_CACHE_SIZE    = 2
+REMAP_CACHE_BYTES   = 128*1024*1024
+
+# Used in ocr.py
+OCR_WARMUP_SIZE = 256
+
+# Used in imaging.py, the original is reloaded when needed and only previewed at PREVIEW_HEIGHT while its crop is edited
+JOB_THREADS = 3
+PREVIEW_HEIGHT = 1000
+
+# Used in sources.py
+PDF_RENDER_DPI = 300
+
+# Used in imaging.py and cache.py, RESULT_HEIGHT is the final shown in the result view.
+# Processed pages are kept encoded, CACHE_BYTES only holds finals rendered again for saving as an image.
+RESULT_HEIGHT   = 600
+CACHE_BYTES     = 128*1024*1024
+CROP_CACHE_BYTES = 256*1024*1024
+
+# Used in concurrency.py, THREADS_ENV overrides the detected CPU count
+THREADS_ENV     = 'BOOK_THREADS'
+OCR_CPU_SHARE   = 0.5
+
+# Used in service.py, pages nobody has asked about for SERVICE_PAGE_EXPIRY seconds are forgotten
+SERVICE_PORT        = 8765
+SERVICE_PAGE_EXPIRY = 3600
+
+# Used in distributed.py, the timeout covers a whole shard including the worker's model warm up
+DISTRIBUTED_PORT        = 8766
+DISTRIBUTED_SHARD_SIZE  = 8
+DISTRIBUTED_RETRIES     = 2
+DISTRIBUTED_TIMEOUT     = 600
+
+# Used in tuning.py, main.py and service.py, a tuned profile overrides any of the values above
+PROFILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profile.json')
+
+def load_profile(path=PROFILE_PATH) -> dict:
+    with open(path) as f:
+        profile = json.load(f)
+    for name, value in profile.items():
+        if name.isupper() and name in globals():
+            globals()[name] = value
+    return profile
@@ -1,9 +1,13 @@
 import constants
+from tiling import TileUtils
+from warping import remaps
 
-import cv2, colorsys, imutils, numpy as np
+import cv2, colorsys, imutils, threading, numpy as np
 from PIL import Image
 
-import keras_ocr.pipeline
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import keras_ocr.pipeline
 
 class Line(object):
     def __init__(self, rho=None, t=None):
@@ -72,7 +76,67 @@ class Document(object):
             points.append(p)
         return points
     
+# Corner detection preprocessing on a single channel at the analysis size. Every step writes into buffers
+# that are kept from page to page, they are only reallocated when the page size changes.
+# Not thread safe, DocUtils.preprocessor() hands out one per thread.
+class Preprocessor(object):
+    def __init__(self):
+        self._buffers: dict[str, np.ndarray] = {}
+        self._kernel = np.ones((5,5), np.uint8)
+        self.median = None
+
+    def buffer(self, name, shape) -> np.ndarray:
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self._buffers[name] = np.empty(shape, dtype='uint8')
+        return buffer
+
+    # Luminance, or with EDGE_CHANNEL = 'contrast' whichever colour channel varies most over a sample of the photo.
+    def channel(self, original, sample) -> np.ndarray:
+        out = self.buffer('channel', original.shape[:2])
+        if constants.EDGE_CHANNEL == 'contrast':
+            index = int(np.argmax(sample.reshape(-1, 3).std(axis=0)))
+            return cv2.extractChannel(original, index, dst=out)
+        return cv2.cvtColor(original, cv2.COLOR_BGR2GRAY, dst=out)
+
+    # Also keeps the median of every colour value in a sample of the photo for edges(), the statistic the
+    # original preprocessing takes its Canny thresholds from. A single channel's own median runs lower on
+    # pages with little luminance contrast to the table and lets far too many edges through.
+    def analysis_image(self, original) -> np.ndarray:
+        step = constants.EDGE_SAMPLE_STEP
+        sample = original[::step, ::step]
+        self.median = Preprocessor.histogram_median(np.bincount(sample.ravel(), minlength=256))
+
+        channel = self.channel(original, sample)
+        h, w = channel.shape
+        height = constants.ANALYSIS_HEIGHT
+        width = int(w*height/h)
+        return cv2.resize(channel, (width, height), dst=self.buffer('analysis', (height, width)), interpolation=cv2.INTER_AREA)
+
+    # Same steps as DocUtils.legacy_edges, on the single channel from analysis_image and with its median.
+    def edges(self, image) -> np.ndarray:
+        shape = image.shape
+        closed = cv2.morphologyEx(image, cv2.MORPH_CLOSE, self._kernel, dst=self.buffer('closed', shape), iterations=1)
+        blurred = cv2.GaussianBlur(closed, (7,7), 5, dst=self.buffer('blurred', shape))
+        sharp = cv2.addWeighted(closed, 2.5, blurred, -1.5, 0, dst=self.buffer('sharp', shape))
+        smooth = cv2.GaussianBlur(sharp, (7,7), 0, dst=blurred)
+
+        v = self.median if self.median is not None else Preprocessor.histogram_median(np.bincount(smooth.ravel(), minlength=256))
+        lower = int(max(0, (1.0 - constants.CANNY_SIGMA)*v))
+        upper = int(min(255, (1.0 + constants.CANNY_SIGMA)*v))
+        return cv2.Canny(smooth, lower, upper, edges=self.buffer('edges', shape), apertureSize=3)
+
+    # Same value as np.median of the values counted in a 256 bin histogram, without sorting them.
+    def histogram_median(counts) -> float:
+        counts = np.cumsum(counts)
+        total = int(counts[-1])
+        low = np.searchsorted(counts, (total - 1)//2 + 1)
+        high = np.searchsorted(counts, total//2 + 1)
+        return (low + high)/2
+
 class DocUtils:
+    _local = threading.local()
+
     # Comes from https://pyimagesearch.com/2014/08/25/4-point-opencv-getperspective-transform-example
     # Sorts points into tl, tr, br, bl
     def order_point(pts) -> np.ndarray:
@@ -110,17 +174,117 @@ class DocUtils:
             [0, max_height - 1]], dtype="float32")
 
         matrix = cv2.getPerspectiveTransform(rect, dst)
+        if TileUtils.is_large((max_height, max_width)):
+            return TileUtils.warp_perspective(img, matrix, (max_width, max_height))
+        if constants.REMAP_WARP:
+            return remaps.warp(img, rect, matrix, (max_width, max_height))
         return cv2.warpPerspective(img, matrix, (max_width, max_height))
 
+    # Crops several (image, corners) pages at once in parallel threads, OpenCV drops the GIL for the warps.
+    def crop_documents(pages, checkpoint=None) -> list[cv2.Mat]:
+        checkpoint = checkpoint or (lambda: None)
+
+        def crop(page):
+            checkpoint()
+            return DocUtils.crop_document(*page)
+
+        with TileUtils.page_pool() as pool:
+            return list(pool.map(crop, pages))
+
     def midpoint(a, b):
         return (int((a[0] + b[0])/2), int((a[1] + b[1])/2))
     
-    # Returns original image and corners of detected document
-    def find_document(path):
-        original = cv2.imread(path)
-        ratio = original.shape[0] / 600
+    # Returns original image and corners of detected document, path can also be an already decoded image.
+    # checkpoint is called between stages so a running job can be cancelled mid-page.
+    # The cheap contour detector is tried first, the Hough lines only when it finds no page shaped quad.
+    # info, if given, gets the tier that found the page ('contour', 'hough' or 'none').
+    def find_document(path, checkpoint=None, info=None):
+        checkpoint = checkpoint or (lambda: None)
+
+        original = cv2.imread(path) if isinstance(path, str) else path
+        checkpoint()
+        ratio = original.shape[0] / constants.ANALYSIS_HEIGHT
+        if constants.EDGE_CHANNEL == 'color':
+            image = imutils.convenience.resize(original, height=constants.ANALYSIS_HEIGHT)
+        else:
+            image = DocUtils.preprocessor().analysis_image(original)
+
+        tier, found = 'contour', DocUtils.find_quad(image)
+        if found is None:
+            checkpoint()
+            tier, found = 'hough', DocUtils.find_lines(image, checkpoint)
+
+        corners = np.array([(0,0), (original.shape[1], 0), (0, original.shape[0]), (original.shape[1], original.shape[0])])
+        if found is None:
+            tier = 'none'
+        else:
+            corners = np.multiply(found, ratio)
+
+        if info is not None:
+            info['tier'] = tier
+        return original, corners
+
+    def preprocessor() -> Preprocessor:
+        if not hasattr(DocUtils._local, 'preprocessor'):
+            DocUtils._local.preprocessor = Preprocessor()
+        return DocUtils._local.preprocessor
+
+    # The page as the largest bright region, works on clean photos of a page against a darker background.
+    # Returns the corners in the same order as the Hough lines give them, or None if no quad passes page_shaped.
+    def find_quad(image):
+        buffers = DocUtils.preprocessor()
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        gray = cv2.GaussianBlur(gray, (5,5), 0, dst=buffers.buffer('quad_blur', gray.shape))
+        _, region = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=buffers.buffer('quad_region', gray.shape))
+        region = cv2.morphologyEx(region, cv2.MORPH_CLOSE, np.ones((9,9), np.uint8), dst=region)
+
+        contours, _ = cv2.findContours(region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        min_area = constants.CONTOUR_MIN_AREA*image.shape[0]*image.shape[1]
+        for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:constants.CONTOUR_CANDIDATES]:
+            if cv2.contourArea(contour) < min_area:
+                break
 
-        image = imutils.convenience.resize(original.copy(), height=600)
+            hull = cv2.convexHull(contour)
+            quad = cv2.approxPolyDP(hull, constants.CONTOUR_EPSILON*cv2.arcLength(hull, True), True)
+            if len(quad) != 4:
+                continue
+
+            rect = DocUtils.order_point(quad[:, 0].astype('float32'))
+            if DocUtils.page_shaped(rect, image.shape):
+                return rect[[0, 1, 3, 2]]
+        return None
+
+    # Checks the height/width ratio against RATIO_BASE +- RATIO_SIGMA.
+    def page_shaped(rect, shape) -> bool:
+        ratio = DocUtils.page_ratio(rect, shape)
+        return abs(ratio - constants.RATIO_BASE) <= constants.RATIO_SIGMA
+
+    # Height/width of the page itself, undoing the perspective of the photo when the quad shows any.
+    # From Zhang & He, "Whiteboard scanning and image enhancement", assuming square pixels and a centred lens.
+    def page_ratio(rect, shape) -> float:
+        tl, tr, br, bl = rect
+        plain = (np.linalg.norm(bl - tl) + np.linalg.norm(br - tr))/(np.linalg.norm(tr - tl) + np.linalg.norm(br - bl))
+
+        m1, m2, m3, m4 = (np.array([p[0], p[1], 1.0]) for p in (tl, tr, bl, br))
+        k2 = np.dot(np.cross(m1, m4), m3)/np.dot(np.cross(m2, m4), m3)
+        k3 = np.dot(np.cross(m1, m4), m2)/np.dot(np.cross(m3, m4), m2)
+        n2, n3 = k2*m2 - m1, k3*m3 - m1
+        if abs(n2[2]*n3[2]) < 1e-9:
+            return plain
+
+        u0, v0 = shape[1]/2, shape[0]/2
+        f2 = -((n2[0]*n3[0] - (n2[0]*n3[2] + n2[2]*n3[0])*u0 + n2[2]*n3[2]*u0**2)
+             + (n2[1]*n3[1] - (n2[1]*n3[2] + n2[2]*n3[1])*v0 + n2[2]*n3[2]*v0**2))/(n2[2]*n3[2])
+        if f2 <= 0:
+            return plain
+
+        f = np.sqrt(f2)
+        inverse = np.linalg.inv(np.array([[f, 0, u0], [0, f, v0], [0, 0, 1]]))
+        metric = inverse.T @ inverse
+        return float(np.sqrt((n3 @ metric @ n3)/(n2 @ metric @ n2)))
+
+    # The original preprocessing, on all three channels of the analysis image (EDGE_CHANNEL = 'color').
+    def legacy_edges(image):
         edges = image.copy()
 
         # Image processing for HoughLine
@@ -135,11 +299,20 @@ class DocUtils:
         v = np.median(edges)
         lower = int(max(0, (1.0 - constants.CANNY_SIGMA)*v))
         upper = int(min(255, (1.0 + constants.CANNY_SIGMA)*v))
-        edges = cv2.Canny(edges, lower, upper, apertureSize=3)
+        return cv2.Canny(edges, lower, upper, apertureSize=3)
+
+    # The original Hough line detector, returns the corners at the analysis size or None.
+    # A colour image goes through legacy_edges, a single channel through the Preprocessor.
+    def find_lines(image, checkpoint):
+        if image.ndim == 3:
+            edges = DocUtils.legacy_edges(image)
+        else:
+            edges = DocUtils.preprocessor().edges(image)
+        checkpoint()
 
         # Processing HoughLines to find most likely document lines
         strong_lines = Document(image.shape[:2])
-        lines = cv2.HoughLines(edges, 1, np.pi/180, 60)
+        lines = cv2.HoughLines(edges, 1, np.pi/180, constants.HOUGH_THRESH)
         if lines is not None:
             # Turns all lines into positive rho
             lines = lines[:, 0].tolist()
@@ -148,7 +321,9 @@ class DocUtils:
             candids = np.array([lines[0]])
             strong_lines.add_line(lines[0][0], lines[0][1])
 
-            for line in lines[1:]:
+            for id, line in enumerate(lines[1:]):
+                if id % 64 == 0:
+                    checkpoint()
                 rho, theta = line[0], line[1]
                 
                 closeness_rho = np.isclose(rho, candids[:,0], atol=constants.RHO_THRESH)
@@ -160,28 +335,165 @@ class DocUtils:
                     candids = np.concatenate((candids, [line]))
                     strong_lines.add_line(rho, theta)
 
-        corners = np.array([(0,0), (original.shape[1], 0), (0, original.shape[0]), (original.shape[1], original.shape[0])])
         if strong_lines.document_found() and strong_lines.corners() is not None:
-            corners = np.multiply(strong_lines.corners(), ratio)
-
-        return original, corners
+            return strong_lines.corners()
+        return None
     
-    def text_mask(image, pipeline: keras_ocr.pipeline.Pipeline):
-        ratio = image.shape[0] / 1200
-
-        prediction_image = imutils.convenience.resize(image.copy(), height=1200)
-        prediction_data = pipeline.recognize([prediction_image])
-
-        mask = np.zeros(image.shape[:2], dtype='uint8')
-        for box in prediction_data[0]:
-            bounds = box[1]
+    # Letter sized connected components on a small grayscale copy of the image, as (heights, centers)
+    # in pixels of the given image. Specks, rules and pictures are dropped.
+    def glyph_components(image):
+        ratio = image.shape[0] / constants.GLYPH_ANALYSIS_HEIGHT
+
+        small = imutils.convenience.resize(image, height=constants.GLYPH_ANALYSIS_HEIGHT)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+
+        _, _, stats, centers = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        heights = stats[1:, cv2.CC_STAT_HEIGHT]
+        widths = stats[1:, cv2.CC_STAT_WIDTH]
+
+        glyphs = (heights >= 3) & (heights <= constants.GLYPH_ANALYSIS_HEIGHT*0.08) & (widths <= heights*4)
+        return heights[glyphs]*ratio, centers[1:][glyphs]*ratio
+
+    # Median glyph height in pixels of the given image. None when there are too few components to trust, e.g. on blank pages.
+    def estimate_glyph_height(image, glyphs=None):
+        heights, _ = glyphs if glyphs is not None else DocUtils.glyph_components(image)
+        if len(heights) < constants.GLYPH_MIN_COMPONENTS:
+            return None
+        return float(np.median(heights))
+
+    # Picks the detector input height that brings the page's text to OCR_GLYPH_TARGET pixels,
+    # so large print is detected at a lower resolution and only small print pays for a higher one.
+    def ocr_height(image, glyph_height=None) -> int:
+        if glyph_height is None:
+            return constants.OCR_HEIGHT
+
+        height = image.shape[0]*constants.OCR_GLYPH_TARGET/glyph_height
+        # Snapping to a few sizes keeps TensorFlow from retracing the model for every page.
+        height = int(round(height/constants.OCR_HEIGHT_STEP))*constants.OCR_HEIGHT_STEP
+        return int(np.clip(height, constants.OCR_MIN_HEIGHT, constants.OCR_MAX_HEIGHT))
+
+    # Splits length into as few tiles of at most size as possible, overlapping by overlap.
+    # All tiles get the same length so a page's tiles can go to the model as one batch.
+    def tile_grid(length, size, overlap) -> tuple[list[int], int]:
+        count = max(1, int(np.ceil((length - overlap)/(size - overlap))))
+        tile = int(np.ceil((length + (count - 1)*overlap)/count))
+        return [i*(tile - overlap) for i in range(count)], tile
+
+    # Runs the detector only on tiles that look like they hold text, in batches of equally sized tiles.
+    # A tile is skipped when it has almost no edges, which paper grain, gradients and shadows don't make
+    # at fixed Canny thresholds but any print does, whatever its size or polarity (a lone page number still
+    # gives ~70 edge pixels). Letter shaped components are only a hint that keeps faint text below the edge gate.
+    def detect_tiled(image, pipeline: 'keras_ocr.pipeline.Pipeline', centers, info=None) -> list[np.ndarray]:
+        h, w = image.shape[:2]
+        gray = cv2.GaussianBlur(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (3,3), 0)
+        edges = cv2.Canny(gray, constants.OCR_TILE_EDGE_LOW, constants.OCR_TILE_EDGE_HIGH)
+
+        rows, tile_h = DocUtils.tile_grid(h, constants.OCR_TILE_SIZE, constants.OCR_TILE_OVERLAP)
+        cols, tile_w = DocUtils.tile_grid(w, constants.OCR_TILE_SIZE, constants.OCR_TILE_OVERLAP)
+
+        tiles = [(x, y) for y in rows for x in cols]
+        text_tiles = []
+        for x, y in tiles:
+            if np.count_nonzero(edges[y:y+tile_h, x:x+tile_w]) >= constants.OCR_TILE_MIN_EDGES:
+                text_tiles.append((x, y))
+                continue
+            inside = (centers[:,0] >= x) & (centers[:,0] < x + tile_w) & (centers[:,1] >= y) & (centers[:,1] < y + tile_h)
+            if np.count_nonzero(inside) >= constants.OCR_TILE_MIN_GLYPHS:
+                text_tiles.append((x, y))
+
+        if info is not None:
+            info['tiles'] = len(tiles)
+            info['text_tiles'] = len(text_tiles)
+
+        # Same upscale keras-ocr would have applied to the whole page.
+        scale = min(pipeline.scale, pipeline.max_size / max(h, w))
+
+        # Mostly text, the overlap between tiles would cost more than the skipped tiles save.
+        if len(text_tiles) >= len(tiles)*constants.OCR_TILE_FULL_PAGE:
+            page = cv2.resize(image, (int(w*scale), int(h*scale)))
+            return [np.asarray(box, dtype='float32')/scale for box in pipeline.detector.detect([page])[0]]
+
+        size = (int(tile_w*scale), int(tile_h*scale))
+        boxes = []
+        for i in range(0, len(text_tiles), constants.OCR_TILE_BATCH):
+            batch = text_tiles[i:i + constants.OCR_TILE_BATCH]
+            images = [cv2.resize(image[y:y+tile_h, x:x+tile_w], size) for x, y in batch]
+
+            for (x, y), tile_boxes in zip(batch, pipeline.detector.detect(images)):
+                for box in tile_boxes:
+                    boxes.append(((x, y, tile_w, tile_h), np.asarray(box, dtype='float32')/scale + (x, y)))
+        return DocUtils.stitch_boxes(boxes)
+
+    # A text line crossing a tile seam comes back as a piece from each tile (or twice, once whole and once cut).
+    # Pieces from different tiles that overlap on the same line are joined into one box.
+    def stitch_boxes(boxes) -> list[np.ndarray]:
+        margin = constants.OCR_TILE_OVERLAP
+
+        def at_seam(tile, box):
+            x, y, w, h = tile
+            return (box[:,0].min() < x + margin or box[:,0].max() > x + w - margin or
+                    box[:,1].min() < y + margin or box[:,1].max() > y + h - margin)
+
+        inner = [box for tile, box in boxes if not at_seam(tile, box)]
+        seam = [({tile}, box) for tile, box in boxes if at_seam(tile, box)]
+
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(seam)):
+                for j in range(i + 1, len(seam)):
+                    (tiles_a, a), (tiles_b, b) = seam[i], seam[j]
+                    if tiles_a & tiles_b or not DocUtils.same_line(a, b):
+                        continue
+
+                    both = np.concatenate((a, b))
+                    (x0, y0), (x1, y1) = both.min(axis=0), both.max(axis=0)
+                    seam[i] = (tiles_a | tiles_b, np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], dtype='float32'))
+                    seam.pop(j)
+                    merged = True
+                    break
+                if merged:
+                    break
+
+        return inner + [box for _, box in seam]
+
+    def same_line(a, b) -> bool:
+        overlap_x = min(a[:,0].max(), b[:,0].max()) - max(a[:,0].min(), b[:,0].min())
+        overlap_y = min(a[:,1].max(), b[:,1].max()) - max(a[:,1].min(), b[:,1].min())
+        height = min(np.ptp(a[:,1]), np.ptp(b[:,1]))
+        return overlap_x >= 0 and height > 0 and overlap_y/height > constants.OCR_STITCH_OVERLAP
+
+    # info, if given, gets the estimated glyph height, the chosen detector height and the tile counts for benchmarking.
+    def text_mask(image, pipeline: 'keras_ocr.pipeline.Pipeline', info=None):
+        glyphs = DocUtils.glyph_components(image)
+        glyph_height = DocUtils.estimate_glyph_height(image, glyphs)
+        height = DocUtils.ocr_height(image, glyph_height)
+        ratio = image.shape[0] / height
+
+        if info is not None:
+            info['glyph_height'] = glyph_height
+            info['ocr_height'] = height
+
+        prediction_image = imutils.convenience.resize(image, height=height)
+        if constants.OCR_TILED:
+            boxes = DocUtils.detect_tiled(prediction_image, pipeline, glyphs[1]/ratio, info)
+        else:
+            boxes = [box[1] for box in pipeline.recognize([prediction_image])[0]]
+
+        mask = TileUtils.allocate(image.shape[:2], zero=True)
+        for bounds in boxes:
             pos = [(bounds[i][0]*ratio, bounds[i][1]*ratio) for i in range(4)]
             thickness = int(np.sqrt((pos[2][0] - pos[1][0])**2 + (pos[2][1] - pos[1][1])**2))
             cv2.line(mask, DocUtils.midpoint(pos[1], pos[2]), DocUtils.midpoint(pos[0], pos[3]), 255, thickness)
         return mask
     
     def resized_final(image, mask, height=None, width=None):
-        resized = cv2.inpaint(image, mask, 7, cv2.INPAINT_NS) if mask is not None else image
+        resized = image
+        if mask is not None and TileUtils.is_large(image.shape):
+            resized = TileUtils.inpaint(image, mask, 7, cv2.INPAINT_NS)
+        elif mask is not None:
+            resized = cv2.inpaint(image, mask, 7, cv2.INPAINT_NS)
 
         if height is None:
             resized = imutils.convenience.resize(resized, width=width)
@@ -189,5 +501,8 @@ class DocUtils:
             resized = imutils.convenience.resize(resized, height=height)
         return resized
     
+    def decode_image(data: bytes):
+        return cv2.imdecode(np.frombuffer(data, dtype='uint8'), cv2.IMREAD_COLOR)
+
     def opencv_to_pil(image):
         return Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
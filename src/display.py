@@ -41,6 +41,10 @@ class MainWindow(QMainWindow):
 
         self.crop_widget.crop_bound.connect(self.load_widget.recrop_model)
 
+        # The original is loaded in a job, the editor only opens once its preview has arrived.
+        self.result_widget.edit_crop.connect(self.load_widget.preview_model)
+        self.load_widget.preview_ready.connect(self._edit_crop)
+
         self.stack_layout = QStackedLayout()
         self.stack_layout.addWidget(self.upload_widget)
         self.stack_layout.addWidget(self.load_widget)
@@ -65,9 +69,12 @@ class MainWindow(QMainWindow):
             case View.RESULT:
                 self.stack_layout.setCurrentWidget(self.result_widget)
             case View.EDIT_CROP:
-                self.crop_widget.model = self.result_widget.selected.model
                 self.stack_layout.setCurrentWidget(self.crop_widget)
 
+    def _edit_crop(self, m):
+        self.crop_widget.model = m
+        self._set_view(View.EDIT_CROP)
+
 class UploadWidget(QWidget, ViewWidget):
     files_ready = pyqtSignal(list)
 
@@ -110,13 +117,13 @@ class UploadWidget(QWidget, ViewWidget):
             e.setDropAction(Qt.DropAction.CopyAction)
             e.accept()
 
-            # Parse all the files and make sure there are only images.
+            # Parse all the files and make sure there are only images or page containers.
             links = []
             if e.mimeData().urls() is None:
                 return
             for r in e.mimeData().urls():
                 file = QFileInfo(r.toLocalFile())
-                if file.suffix() not in constants.ACCEPTABLE_FILES:
+                if file.suffix().lower() not in constants.ACCEPTABLE_FILES:
                     return
                 links.append(file.absoluteFilePath())
 
@@ -247,33 +254,50 @@ class PagesWidget(QLabel):
 
         del_action = QAction("Delete", self)
         del_action.triggered.connect(lambda: self.delete.emit(self))
-        save_action = QAction("Save as Image", self)
-        save_action.triggered.connect(lambda: self.save.emit(self.model))
+        self._save_action = QAction("Save as Image", self)
+        self._save_action.triggered.connect(lambda: self.save.emit(self.model))
 
         self.menu = QMenu(self)
         self.menu.addAction(del_action)
-        self.menu.addAction(save_action)
+        self.menu.addAction(self._save_action)
 
+        # Pages still being processed start out as empty placeholders and get their model later.
+        self.model = None
+        self.failed = False
+        self.set_model(model)
+
+    def set_model(self, model: ImageModel):
         self.model = model
+        self._save_action.setEnabled(self.model is not None)
         if self.model is not None:
             self.model.content_changed.connect(lambda: self.setPixmap(self.model.final_pix))
             self.setPixmap(self.model.final_pix)
+        else:
+            self.setText("Processing...")
+            self.setAlignment(Qt.AlignmentFlag.AlignCenter)
+
+    # The page failed or its batch ended without it, it can only be deleted.
+    def set_failed(self):
+        self.failed = True
+        self.setText("Not processed")
 
     def __del__(self):
         del self.model
 
     def contextMenuEvent(self, e):
+        if self.model is None and not self.failed:
+            return
         self.menu.exec(e.globalPos())
 
     def mousePressEvent(self, e: QMouseEvent):
-        if e.buttons() == Qt.MouseButton.LeftButton:
+        if e.buttons() == Qt.MouseButton.LeftButton and self.model is not None:
             self.clicked.emit(self.model)
             e.accept()
         else:
             e.ignore()
 
     def mouseMoveEvent(self, e: QMouseEvent):
-        if e.buttons() == Qt.MouseButton.LeftButton:
+        if e.buttons() == Qt.MouseButton.LeftButton and self.model is not None:
             drag = QDrag(self)
             drag.setMimeData(QMimeData())
 
@@ -351,23 +375,28 @@ class SelPageWidget(QLabel):
         if self._model is None:
             return
         image = self._model.orig_pix if self._show_org else self._model.final_pix
+        if image is None:
+            return
         self.setPixmap(image.scaled(self.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation))
 
 class ResultWidget(QWidget, ViewWidget):
     save_file = pyqtSignal(list, str, str)
+    edit_crop = pyqtSignal(ImageModel)
 
     def __init__(self, parent=None):
         super().__init__(parent)
 
         self.selected = SelPageWidget()
         self._pages = PageWrapperWidget()
+        # Placeholder widgets by page index, filled in as the batch delivers each page.
+        self._pending: dict[int, PagesWidget] = {}
 
         scroll_widget = QScrollArea()
         scroll_widget.setWidgetResizable(True)
         scroll_widget.setWidget(self._pages)
 
         compile_button = QPushButton("Compile")
-        compile_button.clicked.connect(lambda: self._save_model_as(self._pages.list_models(), "PDF (*.pdf)"))
+        compile_button.clicked.connect(self._compile)
 
         right_layout = QVBoxLayout()
         right_layout.addWidget(scroll_widget)
@@ -391,6 +420,16 @@ class ResultWidget(QWidget, ViewWidget):
         main_layout.addWidget(left_group, 1)
         main_layout.addLayout(right_layout, 2)
 
+    def _compile(self):
+        if len(self._pending) > 0:
+            QMessageBox.about(self, "Alert", "Pages are still being processed.")
+            return
+        models = [model for model in self._pages.list_models() if model is not None]
+        if len(models) == 0:
+            QMessageBox.about(self, "Alert", "No processed pages to compile.")
+            return
+        self._save_model_as(models, "PDF (*.pdf)")
+
     def _save_model_as(self, models, file_type):
         save_name = QFileDialog.getSaveFileName(self, "Save file", 'c:\\', file_type)
         if save_name[0] == "":
@@ -400,16 +439,33 @@ class ResultWidget(QWidget, ViewWidget):
 
     def recieve_result(self, result):
         match result[0]:
-            case 'inputs':
+            case 'start':
                 self._pages.layout().clear()
-                for model in result[1]:
-                    page = PagesWidget(model)
+                self._pending = {}
+                for id in range(result[1]):
+                    page = PagesWidget()
                     page.clicked.connect(self._select_model)
                     page.delete.connect(self._delete_widget)
                     page.save.connect(lambda m: self._save_model_as([m], "PNG (*.png)"))
                     self._pages.layout().addWidget(page)
+                    self._pending[id] = page
+            case 'page':
+                page = self._pending.pop(result[1], None)
+                if page is not None:
+                    page.set_model(result[2])
+            case 'failed':
+                page = self._pending.pop(result[1], None)
+                if page is not None:
+                    page.set_failed()
+            case 'done':
+                self._pending = {}
+            # Sent whenever a batch stops, also after an error or a cancel, so no placeholder waits forever.
+            case 'end':
+                for page in self._pending.values():
+                    page.set_failed()
+                self._pending = {}
             case 'recrop':
-                self.selected.model.content_changed.emit()
+                result[1].content_changed.emit()
             case _:
                 pass
 
@@ -418,9 +474,10 @@ class ResultWidget(QWidget, ViewWidget):
 
     def _select_recrop(self):
         if self.selected.model is not None:
-            self.swap.emit(View.EDIT_CROP)
+            self.edit_crop.emit(self.selected.model)
 
     def _delete_widget(self, widget: QWidget):
+        self._pending = {id: page for id, page in self._pending.items() if page is not widget}
         widget.deleteLater()
         self._pages.layout().removeWidget(widget)
         self._pages.layout().update()
@@ -442,7 +499,7 @@ class EditCropWidget(QWidget, ViewWidget):
         edit_button = QPushButton("Save Edit")
         edit_button.clicked.connect(self._save_edit)
         exit_button = QPushButton("Return")
-        exit_button.clicked.connect(lambda: self.swap.emit(View.RESULT))
+        exit_button.clicked.connect(lambda: self._leave(View.RESULT))
 
         button_layout = QHBoxLayout()
         button_layout.addWidget(exit_button)
@@ -468,14 +525,20 @@ class EditCropWidget(QWidget, ViewWidget):
     
     @model.setter
     def model(self, m: ImageModel):
+        if self.model is not None and self.model is not m:
+            self.model.release_preview()
         self._main_widget.update_model(m)
         self._model_widget.model = m
 
     def _save_edit(self):
         self._model_widget.model.corner = self._main_widget.crop_bound()
         self.crop_bound.emit(self._model_widget.model)
-        self.swap.emit(View.LOAD)
-        pass
+        self._leave(View.LOAD)
+
+    # The preview is only needed while the page is on screen here.
+    def _leave(self, view):
+        self.model.release_preview()
+        self.swap.emit(view)
 
 class CropWidget(QLabel):
     def __init__(self, parent=None):
@@ -489,7 +552,7 @@ class CropWidget(QLabel):
 
     def update_model(self, m: ImageModel):
         self._dots = []
-        self._h, self._w = m.orig.shape[:2]
+        self._h, self._w = m.orig_shape[:2]
 
         for x, y in m.corner: 
             self._dots.append(QPointF(x, y))
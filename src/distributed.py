@@ -0,0 +1,339 @@
+import concurrency
+concurrency.budget().apply_env()
+
+from detection import DocUtils
+from ocr import OcrModel
+from pdf import EncodedPage, encode_page, write_pdf
+from sources import open_pages
+import constants
+
+import argparse, json, os, queue, shutil, socket, socketserver, struct, subprocess, sys, threading, time, traceback
+import cv2, numpy as np
+
+# Spreads one book over several machines.
+#
+# Workers listen on a port and process shards of pages (detect, crop, text mask, render the export page).
+# The coordinator splits the pages of the given files into shards, sends each to whichever worker is free, retries shards
+# of workers that fail on the remaining ones, and writes the PDF in page order from the returned pages.
+#
+# Every message is a 4 byte length, a JSON header, then the binary blobs whose sizes the header lists.
+
+def send_message(sock: socket.socket, header: dict, blobs=()):
+    header = dict(header, blobs=[len(blob) for blob in blobs])
+    data = json.dumps(header).encode()
+    sock.sendall(struct.pack('!I', len(data)) + data)
+    for blob in blobs:
+        sock.sendall(blob)
+
+def recv_exact(sock: socket.socket, size) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed mid message")
+        data += chunk
+    return bytes(data)
+
+def recv_message(sock: socket.socket) -> tuple[dict, list[bytes]]:
+    size, = struct.unpack('!I', recv_exact(sock, 4))
+    header = json.loads(recv_exact(sock, size))
+    return header, [recv_exact(sock, blob) for blob in header['blobs']]
+
+### ------------------------------------------------------------------------------ ###
+
+class WorkerHandler(socketserver.BaseRequestHandler):
+    model: OcrModel = None
+    # Keras models are not safe to call from several threads at once, and every connection has its own thread.
+    ocr_lock: threading.Lock = None
+
+    def handle(self):
+        while True:
+            try:
+                header, blobs = recv_message(self.request)
+            except ConnectionError:
+                return
+
+            match header['type']:
+                case 'ping':
+                    send_message(self.request, {'type': 'pong', 'ready': self.model.is_ready()})
+                case 'shard':
+                    try:
+                        pages, out = self._process(header['pages'], blobs)
+                        send_message(self.request, {'type': 'result', 'pages': pages}, out)
+                    except Exception:
+                        send_message(self.request, {'type': 'error', 'error': traceback.format_exc()})
+                case _:
+                    send_message(self.request, {'type': 'error', 'error': f"Unknown message {header['type']}"})
+
+    def _process(self, pages, blobs):
+        pipeline = self.model.get()
+        origs, corners = [], []
+        for page, data in zip(pages, blobs):
+            orig = DocUtils.decode_image(data)
+            if orig is None:
+                raise ValueError(f"Could not decode page {page['index']}")
+            origs.append(orig)
+            corners.append(DocUtils.find_document(orig)[1])
+
+        # Pages of a shard usually come from the same rig, so their warps share remap maps and run side by side.
+        crops = DocUtils.crop_documents(list(zip(origs, corners)))
+        del origs
+
+        results, out = [], []
+        for page, corner, crop in zip(pages, corners, crops):
+            with self.ocr_lock:
+                mask = DocUtils.text_mask(crop, pipeline)
+            encoded = encode_page(DocUtils.resized_final(crop, mask, width=constants.SAVE_WIDTH))
+
+            results.append({'index': page['index'], 'corners': np.asarray(corner).tolist(),
+                            'width': encoded.width, 'height': encoded.height})
+            out += [cv2.imencode('.png', mask)[1].tobytes(), encoded.data]
+        return results, out
+
+def run_worker(host, port):
+    model = OcrModel()
+    model.start()
+
+    handler = type('BoundWorkerHandler', (WorkerHandler,), {'model': model, 'ocr_lock': threading.Lock()})
+    server = socketserver.ThreadingTCPServer((host, port), handler)
+    server.daemon_threads = True
+    print(f"listening {server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+### ------------------------------------------------------------------------------ ###
+
+# The worker answered but could not process the shard, the worker itself is fine.
+class ShardError(Exception):
+    pass
+
+class PageResult(object):
+    def __init__(self, index, corners, mask, page: EncodedPage):
+        self.index = index
+        self.corners = corners
+        self.mask = mask
+        self.page = page
+
+class WorkerStats(object):
+    def __init__(self, address):
+        self.address = address
+        self.pages = 0
+        self.shards = 0
+        self.failures = 0
+        self.busy = 0.0
+        self.alive = True
+
+    def throughput(self) -> float:
+        return self.pages/self.busy if self.busy > 0 else 0.0
+
+class Coordinator(object):
+    def __init__(self, paths, workers, shard_size=None):
+        # Multi-page files are expanded here, their pages are only read when their shard is sent.
+        self.pages = open_pages(paths)
+        shard_size = shard_size or constants.DISTRIBUTED_SHARD_SIZE
+        self.shards = [list(range(i, min(i + shard_size, len(self.pages)))) for i in range(0, len(self.pages), shard_size)]
+        self.workers = [WorkerStats(address) for address in workers]
+
+        self.results: dict[int, PageResult] = {}
+        self._lock = threading.Lock()
+        self._pending = queue.Queue()
+        self._retries = [0]*len(self.shards)
+        self._remaining = len(self.shards)
+        self._done = threading.Event()
+        self.error = None
+
+    def run(self) -> dict[int, PageResult]:
+        for id in range(len(self.shards)):
+            self._pending.put(id)
+        if len(self.shards) == 0:
+            return self.results
+
+        threads = [threading.Thread(target=self._drive, args=(stats,), daemon=True) for stats in self.workers]
+        for thread in threads:
+            thread.start()
+        self._done.wait()
+
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.results
+
+    # One thread per worker, it keeps taking shards until the queue is drained or the worker fails.
+    def _drive(self, stats: WorkerStats):
+        try:
+            sock = socket.create_connection(stats.address, timeout=constants.DISTRIBUTED_TIMEOUT)
+        except OSError:
+            self._worker_lost(stats, None)
+            return
+
+        with sock:
+            while not self._done.is_set():
+                try:
+                    id = self._pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                blobs = self._read_shard(id)
+                if blobs is None:
+                    return
+
+                # Only socket and protocol errors past this point take the worker out of the rotation.
+                start = time.perf_counter()
+                try:
+                    pages = self._send_shard(sock, id, blobs)
+                except ShardError as e:
+                    self._shard_failed(stats, id, str(e))
+                    continue
+                except Exception:
+                    self._worker_lost(stats, id, traceback.format_exc())
+                    return
+
+                with self._lock:
+                    stats.busy += time.perf_counter() - start
+                    stats.pages += len(pages)
+                    stats.shards += 1
+                    for page in pages:
+                        self.results[page.index] = page
+                    self._remaining -= 1
+                    if self._remaining == 0:
+                        self._done.set()
+
+    # A local page that can't be read fails the whole book, no worker would do better with it.
+    def _read_shard(self, id) -> list[bytes] | None:
+        blobs = []
+        for index in self.shards[id]:
+            try:
+                blobs.append(self.pages[index].read())
+            except Exception as e:
+                with self._lock:
+                    if not self._done.is_set():
+                        self.error = f"Could not read page {index} ({self.pages[index].name}): {e}"
+                        self._done.set()
+                return None
+        return blobs
+
+    def _send_shard(self, sock, id, blobs) -> list[PageResult]:
+        indexes = self.shards[id]
+        send_message(sock, {'type': 'shard', 'pages': [{'index': i} for i in indexes]}, blobs)
+        header, blobs = recv_message(sock)
+        if header['type'] == 'error':
+            raise ShardError(header['error'])
+        if header['type'] != 'result':
+            raise ConnectionError(f"Unexpected reply {header['type']}")
+
+        pages = []
+        for id, page in enumerate(header['pages']):
+            mask = cv2.imdecode(np.frombuffer(blobs[2*id], dtype='uint8'), cv2.IMREAD_GRAYSCALE)
+            encoded = EncodedPage(blobs[2*id + 1], page['width'], page['height'])
+            pages.append(PageResult(page['index'], np.asarray(page['corners']), mask, encoded))
+        return pages
+
+    # The worker is dropped and its shard goes back in the queue for the others.
+    def _worker_lost(self, stats: WorkerStats, id, error=None):
+        with self._lock:
+            stats.alive = False
+            print(f"worker {stats.address[0]}:{stats.address[1]} lost" + (f": {error.strip().splitlines()[-1]}" if error else ""), flush=True)
+            if id is not None:
+                self._retry(stats, id, error)
+
+            if not self._done.is_set() and not any(worker.alive for worker in self.workers):
+                self.error = "No workers left with shards still to do"
+                self._done.set()
+
+    def _shard_failed(self, stats: WorkerStats, id, error):
+        with self._lock:
+            self._retry(stats, id, error)
+
+    # Shards are retried up to DISTRIBUTED_RETRIES times before the whole book fails.
+    def _retry(self, stats: WorkerStats, id, error):
+        stats.failures += 1
+        self._retries[id] += 1
+        if self._retries[id] > constants.DISTRIBUTED_RETRIES:
+            self.error = f"Shard {id} failed {self._retries[id]} times, last error:\n{error}"
+            self._done.set()
+        else:
+            self._pending.put(id)
+
+    def write_pdf(self, path):
+        write_pdf(path, [self.results[index].page for index in range(len(self.pages))], resolution=100.0)
+
+    def report(self, elapsed):
+        for stats in self.workers:
+            state = 'ok' if stats.alive else 'lost'
+            print(f"{stats.address[0]}:{stats.address[1]:<6} {state:<5} shards {stats.shards:>4}  pages {stats.pages:>5}  "
+                  f"{stats.throughput():6.2f} pages/s")
+        print(f"total {len(self.results)} pages in {elapsed:.2f}s, {len(self.results)/elapsed:.2f} pages/s")
+
+def parse_address(text) -> tuple[str, int]:
+    host, port = text.rsplit(':', 1)
+    return host, int(port)
+
+# Starts count worker processes on localhost, each pinned to its own share of the cores.
+def spawn_local_workers(count) -> tuple[list[subprocess.Popen], list[tuple[str, int]]]:
+    budget = concurrency.budget()
+    procs, addresses = [], []
+    for id in range(count):
+        cpus = budget.worker_cpus(id, count)
+        env = dict(os.environ)
+        env[constants.THREADS_ENV] = str(max(1, len(cpus)))
+
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', '--port', '0',
+            '--cpus', ','.join(str(cpu) for cpu in cpus)], env=env, stdout=subprocess.PIPE, text=True)
+        line = proc.stdout.readline().split()
+        if len(line) != 2 or line[0] != 'listening':
+            proc.kill()
+            raise RuntimeError("Local worker failed to start")
+        # Keep the pipe drained after the handshake, a full pipe would block the worker's next print.
+        threading.Thread(target=shutil.copyfileobj, args=(proc.stdout, sys.stderr), daemon=True).start()
+        procs.append(proc)
+        addresses.append(('127.0.0.1', int(line[1])))
+    return procs, addresses
+
+def coordinate(paths, addresses, out, shard_size):
+    start = time.perf_counter()
+    coordinator = Coordinator(paths, addresses, shard_size)
+    coordinator.run()
+    coordinator.write_pdf(out)
+    coordinator.report(time.perf_counter() - start)
+    return coordinator
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Process a book across several worker processes or machines.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    worker = commands.add_parser('worker', help="serve shards of pages")
+    worker.add_argument('--host', default='127.0.0.1', help="use 0.0.0.0 to accept coordinators from the LAN")
+    worker.add_argument('--port', type=int, default=constants.DISTRIBUTED_PORT)
+    worker.add_argument('--cpus', default=None, help="comma separated cores to pin this worker to")
+
+    for name, help in (('coordinate', "send a book to running workers"), ('local', "start workers on this machine and send them a book")):
+        command = commands.add_parser(name, help=help)
+        command.add_argument('images', nargs='+')
+        command.add_argument('--out', required=True, help="PDF to write")
+        command.add_argument('--shard-size', type=int, default=None)
+        if name == 'coordinate':
+            command.add_argument('--workers', required=True, help="comma separated host:port list")
+        else:
+            command.add_argument('--workers', type=int, default=2, help="worker processes to start")
+
+    args = parser.parse_args()
+    if os.path.exists(constants.PROFILE_PATH):
+        constants.load_profile()
+
+    match args.command:
+        case 'worker':
+            if args.cpus:
+                concurrency.pin_process([int(cpu) for cpu in args.cpus.split(',')])
+            concurrency.budget().apply_opencv()
+            print(f"Thread budget: {concurrency.budget()}", file=sys.stderr, flush=True)
+            run_worker(args.host, args.port)
+        case 'coordinate':
+            coordinate(args.images, [parse_address(a) for a in args.workers.split(',')], args.out, args.shard_size)
+        case 'local':
+            procs, addresses = spawn_local_workers(args.workers)
+            try:
+                coordinate(args.images, addresses, args.out, args.shard_size)
+            finally:
+                for proc in procs:
+                    proc.kill()
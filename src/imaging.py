@@ -1,16 +1,23 @@
 from views import View, ViewWidget
 from detection import DocUtils
+from tiling import TileUtils
+from ocr import OcrModel
+from pdf import EncodedPage, ExportCache, export_key, write_pdf
+from sources import PageSource, open_pages
+from cache import crops, derivatives, derivative_key
+from warping import remaps
+import concurrency
 import constants
 
-import traceback
-
-from keras_ocr.pipeline import Pipeline
-from keras import backend as K
+import traceback, weakref
+from enum import IntEnum
+from functools import partial
 
+import cv2, numpy as np
 from PIL import Image
 
 from PyQt6.QtCore import (
-    Qt, pyqtSignal, pyqtSlot, QObject,
+    Qt, pyqtSignal, pyqtSlot, QObject, QCoreApplication,
     QThreadPool, QRunnable, QMutex, QMutexLocker
 )
 from PyQt6.QtWidgets import (
@@ -24,11 +31,22 @@ class WorkerSignals(QObject):
     finished = pyqtSignal()
     error = pyqtSignal(str)
     result = pyqtSignal(object)
+    page = pyqtSignal(object)
     progress = pyqtSignal(str, int, int)
 
+# Higher priority jobs are taken off the pool's queue first, so interactive work never waits behind a batch.
+class Priority(IntEnum):
+    BATCH       = 0
+    INTERACTIVE = 10
+
+class JobCancelled(Exception):
+    pass
+
 # Any function going in here should be able to take the worker object.
 class Worker(QRunnable):
-    def __init__(self, fn_run, *args, **kwargs):
+    _next_id = 0
+
+    def __init__(self, fn_run, *args, priority=Priority.BATCH, **kwargs):
         super().__init__()
         self.fn_run = fn_run
         self.args = args
@@ -36,55 +54,135 @@ class Worker(QRunnable):
         self.signals = WorkerSignals()
         self.mutex = QMutex()
         self.is_stop = False
+        self.priority = priority
+
+        self.id = Worker._next_id
+        Worker._next_id += 1
 
     @pyqtSlot()
     def run(self):
         result = None
         try:
-            with QMutexLocker(self.mutex):
-                self.is_stop = False
+            self.check_stop()
             result = self.fn_run(self, *self.args, **self.kwargs)
+        except JobCancelled:
+            result = None
         except:
             self.signals.error.emit(traceback.format_exc())
-        else:
-            self.signals.finished.emit()
         finally:
             if result is not None:
                 self.signals.result.emit(result)
+            self.signals.finished.emit()
 
     def stop(self):
         with QMutexLocker(self.mutex):
             self.is_stop = True
 
+    # Passed down into the long image stages so a stop request is honoured mid-page.
+    def check_stop(self):
+        with QMutexLocker(self.mutex):
+            if self.is_stop:
+                raise JobCancelled()
+
 class ImageModel(QObject):
     content_changed = pyqtSignal()
 
-    def __init__(self, orig, corner, mask, final, parent=None):
+    # Only a preview of the original is kept, so a long book doesn't hold every full size page in memory.
+    def __init__(self, source: PageSource, orig, corner, mask, parent=None):
         super().__init__(parent)
-        self.orig = orig
+        self.source = source
+        self.orig_shape = orig.shape
         self.corner = corner
+        self.mask_version = 0
         self.tx_mask = mask
-
+        self.export_cache = ExportCache()
+
+        # Derived images outlive a job, they are dropped with the model or when the cache runs out of room.
+        self.cache_id = derivatives.new_owner()
+        weakref.finalize(self, derivatives.discard, self.cache_id)
+        weakref.finalize(self, crops.discard, self.cache_id)
+
+        # Only built while the page is being edited, see render_preview().
+        self.orig_pix = None
+        self.final_image = None
+        self.final_pix = None
+
+    # Decoded again from the source every time, callers should hold on to it for the length of a job.
+    @property
+    def orig(self):
+        return self.source.load()
+
+    # A PREVIEW_HEIGHT image of the original for the crop editor, reloaded from the source each time the page
+    # is edited so a long batch doesn't keep one per page. Decoding the original is slow, so this runs in a job
+    # and the GUI thread turns the result into orig_pix with set_preview().
+    def render_preview(self) -> QImage:
+        orig = self.orig
         h, w, ch = orig.shape
-        self.orig_pix = QPixmap.fromImage(QImage(orig, w, h, ch*w, QImage.Format.Format_BGR888))
+        scale = min(1.0, constants.PREVIEW_HEIGHT/h)
+        preview = np.ascontiguousarray(cv2.resize(orig, (int(w*scale), int(h*scale)), interpolation=cv2.INTER_AREA))
+        h, w = preview.shape[:2]
+        return QImage(preview, w, h, ch*w, QImage.Format.Format_BGR888).copy()
+
+    def set_preview(self, image: QImage):
+        self.orig_pix = QPixmap.fromImage(image)
+
+    def release_preview(self):
+        self.orig_pix = None
+
+    # The mask is binary, it is stored packed to a bit per pixel.
+    # Bumping the version on every new mask is what invalidates the export cache.
+    @property
+    def tx_mask(self):
+        bits, shape = self._tx_mask
+        return np.unpackbits(bits, count=shape[0]*shape[1]).reshape(shape)*np.uint8(255)
+
+    @tx_mask.setter
+    def tx_mask(self, mask):
+        self._tx_mask = np.packbits(mask > 0), mask.shape
+        self.mask_version += 1
+
+    def crop(self):
+        key = derivative_key(self.cache_id, 'crop', self.corner)
+        return crops.get(key, lambda: DocUtils.crop_document(self.orig, self.corner))
+
+    def final(self, height=None, width=None):
+        key = derivative_key(self.cache_id, 'final', self.corner, self.mask_version, height, width)
+        return derivatives.get(key, lambda: DocUtils.resized_final(self.crop(), self.tx_mask, height=height, width=width))
+
+    # Inpaints the crop once for both the result view and the export size, and returns the result view's.
+    # The export page is encoded right away, so compiling after processing only has to write the PDF.
+    # Its decoded pixels are not kept, only saving as an image needs them and final() renders them again.
+    def render_finals(self, crop=None):
+        if crop is None:
+            crop = self.crop()
+        else:
+            crops.put(derivative_key(self.cache_id, 'crop', self.corner), crop)
+
+        inpainted = DocUtils.resized_final(crop, self.tx_mask)
+        final = DocUtils.resized_final(inpainted, None, width=constants.SAVE_WIDTH)
+        self.export_cache.get(export_key(self.corner, self.mask_version, constants.SAVE_WIDTH), lambda: final)
+        return DocUtils.resized_final(inpainted, None, height=constants.RESULT_HEIGHT)
 
-        self.update_final_pix(final)
+    def encoded_page(self, width) -> EncodedPage:
+        return self.export_cache.get(export_key(self.corner, self.mask_version, width), lambda: self.final(width=width))
 
-    def update_final_pix(self, final):
+    # QPixmaps may only be made on the GUI thread. A job leaves a copied QImage with set_final(),
+    # and the GUI thread's slot turns it into final_pix with update_final_pix().
+    def set_final(self, final):
         h, w, ch = final.shape
-        self.final_pix = QPixmap.fromImage(QImage(final, w, h, ch*w, QImage.Format.Format_BGR888))
+        self.final_image = QImage(final, w, h, ch*w, QImage.Format.Format_BGR888).copy()
 
-### ------------------------------------------------------------------------------ ###
+    def update_final_pix(self):
+        if self.final_image is not None:
+            self.final_pix = QPixmap.fromImage(self.final_image)
+            self.final_image = None
 
-class LoadWidget(QWidget, ViewWidget):
-    result_ready = pyqtSignal(tuple)
+### ------------------------------------------------------------------------------ ###
 
+class JobProgress(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
 
-        self._thread_pool = QThreadPool()
-        self._thread_pool.setMaxThreadCount(1) 
-
         self._progress_bar = QProgressBar()
         self._progress_bar.setRange(0, 100)
         self._progress_bar.setFixedWidth(350)
@@ -93,49 +191,91 @@ class LoadWidget(QWidget, ViewWidget):
         self._label = QLabel()
         self._label.resize(300, 20)
 
-        self.worker = None
-        self.pipeline = Pipeline()
-        
         layout = QVBoxLayout()
-        layout.addStretch(1)
         layout.addWidget(self._progress_bar, 0, Qt.AlignmentFlag.AlignHCenter)
         layout.addWidget(self._label, 0, Qt.AlignmentFlag.AlignHCenter)
+        layout.setContentsMargins(0,5,0,5)
+
+        self.setLayout(layout)
+
+    def update_progress(self, text, progress, limit):
+        self._label.setText(text)
+        self._progress_bar.setRange(0, limit)
+        self._progress_bar.setValue(progress)
+
+class LoadWidget(QWidget, ViewWidget):
+    result_ready = pyqtSignal(tuple)
+    preview_ready = pyqtSignal(ImageModel)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        # Independent jobs run side by side, the pool's queue orders whatever is waiting by priority.
+        self._thread_pool = QThreadPool()
+        self._thread_pool.setMaxThreadCount(concurrency.budget().jobs)
+
+        # Keras models are not safe to call from several threads at once, OCR is serialized per page.
+        self._ocr_mutex = QMutex()
+
+        self.jobs: dict[int, tuple[Worker, JobProgress]] = {}
+        # Pages delivered so far by each running batch.
+        self._batches: dict[int, int] = {}
+        # Loaded on a background thread by warm_up(), only jobs that run OCR wait on it.
+        self.model = OcrModel()
+
+        self._job_layout = QVBoxLayout()
+
+        layout = QVBoxLayout()
+        layout.addStretch(1)
+        layout.addLayout(self._job_layout)
         layout.addStretch(1)
         layout.setContentsMargins(50,20,50,20)
         
         self.setLayout(layout)
     
+    def warm_up(self):
+        self.model.start()
+
     def stop_worker(self):
-        if isinstance(self.worker, Worker):
-            self.worker.stop()
+        for worker, _ in self.jobs.values():
+            worker.stop()
 
     # Replace test thread with full thread
     @pyqtSlot(list)
     def recieve_files(self, img_paths):
-        self.start_thread(Worker(self._run_full_thread, img_paths))
+        worker = Worker(self._run_full_thread, img_paths, priority=Priority.BATCH)
+        self._batches[worker.id] = 0
+        self.start_thread(worker)
 
     @pyqtSlot(ImageModel)
     def recrop_model(self, model):
-        self.start_thread(Worker(self._run_recrop_thread, model))
+        self.start_thread(Worker(self._run_recrop_thread, model, priority=Priority.INTERACTIVE))
+
+    @pyqtSlot(ImageModel)
+    def preview_model(self, model):
+        self.start_thread(Worker(self._run_preview_thread, model, priority=Priority.INTERACTIVE))
 
     @pyqtSlot(list, str, str)
     def save_files(self, img, path, type):
-        self.start_thread(Worker(self._run_save_thread, img, path, type))
+        priority = Priority.BATCH if type == "PDF" else Priority.INTERACTIVE
+        self.start_thread(Worker(self._run_save_thread, img, path, type, priority=priority))
 
     def start_thread(self, worker: Worker):
+        progress = JobProgress()
+        self._job_layout.addWidget(progress, 0, Qt.AlignmentFlag.AlignHCenter)
+        self.jobs[worker.id] = (worker, progress)
+
         worker.signals.error.connect(self._error_thread)
         worker.signals.result.connect(self._result_thread)
-        worker.signals.finished.connect(self._finish_thread)
-        worker.signals.progress.connect(self._progress_thread)
-        self._thread_pool.start(worker)
-        self.worker = worker
+        worker.signals.page.connect(partial(self._page_thread, worker.id))
+        worker.signals.finished.connect(partial(self._finish_thread, worker.id))
+        worker.signals.progress.connect(progress.update_progress)
+        self._thread_pool.start(worker, worker.priority)
 
     def _error_thread(self, message):
         print(message)
 
     def _result_thread(self, result):
-        self.worker = None
-        
         match result[0]:
             case 'final':
                 QMessageBox.about(self, "Alert", "File Saved!")
@@ -143,94 +283,154 @@ class LoadWidget(QWidget, ViewWidget):
             case 'singlesave':
                 QMessageBox.about(self, "Alert", "Image Saved!")
                 self.swap.emit(View.RESULT)
+            case 'done':
+                self.result_ready.emit(result)
+            case 'recrop':
+                result[1].update_final_pix()
+                self.result_ready.emit(result)
+                self.swap.emit(View.RESULT)
+            case 'preview':
+                _, model, image = result
+                model.set_preview(image)
+                self.preview_ready.emit(model)
             case _:
                 self.result_ready.emit(result)
                 self.swap.emit(View.RESULT)
 
-    def _finish_thread(self):
-        self._thread_pool.waitForDone()
+    # Pages are handed to the result view as soon as each one is done, the view only switches over for the first.
+    def _page_thread(self, id, result):
+        if result[0] != 'page':
+            self.result_ready.emit(result)
+            return
+
+        result[2].update_final_pix()
+        self.result_ready.emit(result)
+        self._batches[id] += 1
+        if self._batches[id] == 1:
+            self.swap.emit(View.RESULT)
+
+    def _finish_thread(self, id):
+        _, progress = self.jobs.pop(id)
+        self._job_layout.removeWidget(progress)
+        progress.deleteLater()
+
+        # However the batch ended, pages it never delivered stop showing as in progress.
+        if id in self._batches:
+            self.result_ready.emit(('end', self._batches[id]))
+            if self._batches.pop(id) == 0:
+                QMessageBox.critical(self, "Error", "No pages could be processed. Please go back and insert photos.")
+                self.swap.emit(View.UPLOAD)
 
-    def _progress_thread(self, text, progress, limit):
-        self._label.setText(text)
-        self._progress_bar.setRange(0, limit)
-        self._progress_bar.setValue(progress)
+        # Only safe to drop the keras graph once nothing else is using the model.
+        # The remap maps of the book that just ended won't match the next one either.
+        if len(self.jobs) == 0:
+            self.model.clear_session()
+            remaps.clear()
+
+    def _text_mask(self, worker_object: Worker, crop):
+        if not self.model.is_ready():
+            worker_object.signals.progress.emit("Loading Text Model", 0, 0)
+        pipeline = self.model.get(worker_object.check_stop)
+
+        with QMutexLocker(self._ocr_mutex):
+            worker_object.check_stop()
+            return DocUtils.text_mask(crop, pipeline)
 
     def _run_full_thread(self, worker_object: Worker, img_paths):
         worker_object.signals.progress.emit(f"Starting Process", 0, 0)
 
         sorted(img_paths)
 
-        progress = 0
-        limit = len(img_paths)*2
-
-        crops = []
-        result = []
-        for id, img in enumerate(img_paths):
-            worker_object.signals.progress.emit(f"Cropping Image #{id+1}", progress, limit)
-            if worker_object.is_stop:
-                return None
+        # Containers are only counted here, each page is decoded when its turn comes.
+        pages = open_pages(img_paths)
+        limit = len(pages)*2
+
+        worker_object.signals.page.emit(('start', len(pages)))
+        for id, source in enumerate(pages):
+            # A page that fails is reported and skipped, the rest of the batch carries on.
+            try:
+                model = self._process_page(worker_object, id, source, limit)
+            except JobCancelled:
+                raise
+            except Exception:
+                worker_object.signals.error.emit(traceback.format_exc())
+                worker_object.signals.page.emit(('failed', id))
+                continue
+
+            # The model is handed to the GUI thread, which owns it from here on.
+            model.moveToThread(QCoreApplication.instance().thread())
+            worker_object.signals.page.emit(('page', id, model))
             
-            orig, corner = DocUtils.find_document(img)
-            crop = DocUtils.crop_document(orig, corner)
-            progress += 1
+        worker_object.signals.progress.emit("Wrapping up", 1, 1)
+        return 'done', len(pages)
+    
+    def _process_page(self, worker_object: Worker, id, source: PageSource, limit) -> ImageModel:
+        worker_object.signals.progress.emit(f"Cropping Image #{id+1}", 2*id, limit)
+        worker_object.check_stop()
 
-            crops.append((orig, corner, crop))
+        orig, corner = DocUtils.find_document(source.load(), checkpoint=worker_object.check_stop)
+        crop = DocUtils.crop_document(orig, corner)
 
-        for id, (orig, corner, crop) in enumerate(crops):
-            worker_object.signals.progress.emit(f"Removing Text #{id+1}", progress, limit)
-            if worker_object.is_stop:
-                return None
+        worker_object.signals.progress.emit(f"Removing Text #{id+1}", 2*id + 1, limit)
+        worker_object.check_stop()
 
-            mask = DocUtils.text_mask(crop, self.pipeline)
-            final = DocUtils.resized_final(crop, mask, height=600)
-            progress += 1
+        mask = self._text_mask(worker_object, crop)
+        worker_object.check_stop()
+        model = ImageModel(source, orig, corner, mask)
+        model.set_final(model.render_finals(crop))
+        return model
 
-            if worker_object.is_stop:
-                return None
-            
-            result.append(ImageModel(orig, corner, mask, final))
-            
-        worker_object.signals.progress.emit("Wrapping up", 1, 1)
-        K.clear_session()
-        return 'inputs', result
-    
     def _run_recrop_thread(self, worker_object: Worker, model: ImageModel):
         worker_object.signals.progress.emit(f"Starting Process", 0, 0)
 
         worker_object.signals.progress.emit(f"Cropping Image", 0, 2)
-        if worker_object.is_stop:   
-            return None
-        crop = DocUtils.crop_document(model.orig, model.corner)
+        worker_object.check_stop()
+        crop = model.crop()
 
         worker_object.signals.progress.emit(f"Removing Text", 1, 2)
-        if worker_object.is_stop:
-            return None
-        model.tx_mask = DocUtils.text_mask(crop, self.pipeline)
-        model.update_final_pix(DocUtils.resized_final(crop, model.tx_mask, height=600))
+        worker_object.check_stop()
+        model.tx_mask = self._text_mask(worker_object, crop)
+        worker_object.check_stop()
+        model.set_final(model.render_finals(crop))
 
         worker_object.signals.progress.emit("Wrapping up", 1, 1)
-        K.clear_session()
         return 'recrop', model
+
+    def _run_preview_thread(self, worker_object: Worker, model: ImageModel):
+        worker_object.signals.progress.emit(f"Loading Original", 0, 0)
+        return 'preview', model, model.render_preview()
     
+    # Pages missing from the caches are rendered in parallel threads, OpenCV drops the GIL for the warps
+    # and inpainting, and pages from a fixed rig share their remap maps.
+    def _render_pages(self, worker_object: Worker, imgs, render) -> list:
+        def run(model):
+            worker_object.check_stop()
+            return render(model)
+
+        results = []
+        with TileUtils.page_pool() as pool:
+            for id, result in enumerate(pool.map(run, imgs)):
+                worker_object.signals.progress.emit(f"Appending Page {id}", id, len(imgs))
+                results.append(result)
+        return results
+
     def _run_save_thread(self, worker_object: Worker, imgs, path, type):
         worker_object.signals.progress.emit(f"Saving as File", 0, 0)
 
-        progress = 0
-        limit = len(imgs)
+        # PDFs are assembled from each page's cached encoding, only edited pages are encoded again,
+        # and usually from finals already cached when the page was processed.
+        if type == "PDF":
+            pages: list[EncodedPage] = self._render_pages(worker_object, imgs, lambda model: model.encoded_page(constants.SAVE_WIDTH))
 
-        pil_img: list[Image.Image] = []
-        for id, model in enumerate(imgs):
-            worker_object.signals.progress.emit(f"Appending Page {id}", progress, limit)
-            if worker_object.is_stop:
-                return None
-            
-            crop = DocUtils.crop_document(model.orig, model.corner)
-            final = DocUtils.resized_final(crop, model.tx_mask, width=constants.SAVE_WIDTH)
-            pil_img.append(DocUtils.opencv_to_pil(final))
-            progress += 1
+            write_pdf(path, pages, resolution=100.0)
+            worker_object.signals.progress.emit("Done", 1, 1)
+            return 'final', None
+
+        pil_img: list[Image.Image] = self._render_pages(worker_object, imgs,
+            lambda model: DocUtils.opencv_to_pil(model.final(width=constants.SAVE_WIDTH)))
 
         # Could be reused to save as multiple different types
         pil_img[0].save(path, type, resolution=100.0, save_all=True, append_images=pil_img[1:])
 
         worker_object.signals.progress.emit("Done", 1, 1)
-        return 'final' if type == "PDF" else "singlesave", None
\ No newline at end of file
+        return "singlesave", None
\ No newline at end of file
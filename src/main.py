@@ -1,28 +1,53 @@
+import time
+START_TIME = time.perf_counter()
+
+# Thread limits have to be in the environment before numpy, cv2 and TensorFlow load.
+import concurrency
+concurrency.budget().apply_env()
+
 from display import MainWindow
+import constants
 
 import sys
 import os
 
 import qdarktheme
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, QTimer
 from PyQt6.QtWidgets import QApplication
 from PyQt6.QtGui import ( QGuiApplication, QIcon )
 
 # Workaround to show icon on windows taskbar.
 # Took from https://stackoverflow.com/questions/1551605/how-to-set-applications-taskbar-icon-in-windows-7/1552105#1552105
-import ctypes
-myappid = 'mutemini.booktranslatorapp'
-ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
+if sys.platform == 'win32':
+    import ctypes
+    myappid = 'mutemini.booktranslatorapp'
+    ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
 
 os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
 os.environ['MEMORY_ALLOCATED'] = '0.1'
 
+# Used by benchmark.py, prints when the window is up and when the model is warm, then exits.
+def report_startup(window: MainWindow):
+    print(f"window_shown {time.perf_counter() - START_TIME:.3f}", flush=True)
+
+    def poll():
+        if window.load_widget.model.is_ready():
+            print(f"model_ready {time.perf_counter() - START_TIME:.3f}", flush=True)
+            QApplication.quit()
+        else:
+            QTimer.singleShot(50, poll)
+    poll()
+
 if __name__ == '__main__':
+    if os.path.exists(constants.PROFILE_PATH):
+        print(f"Loaded profile: {constants.load_profile()}", flush=True)
+    concurrency.budget().apply_opencv()
+    print(f"Thread budget: {concurrency.budget()}", flush=True)
 
     app = QApplication(sys.argv)
 
     qdarktheme.setup_theme("auto")
-    
+
     max_size = QGuiApplication.primaryScreen().availableSize()
     max_size.scale(800, 600, Qt.AspectRatioMode.KeepAspectRatio)
 
@@ -32,4 +57,9 @@ if __name__ == '__main__':
     window.setWindowIcon(QIcon('icon.ico'))
     window.show()
 
-    sys.exit(app.exec())
\ No newline at end of file
+    # The text model loads while the user is still picking files.
+    QTimer.singleShot(0, window.load_widget.warm_up)
+    if '--startup-time' in sys.argv:
+        QTimer.singleShot(0, lambda: report_startup(window))
+
+    sys.exit(app.exec())
@@ -0,0 +1,60 @@
+import concurrency
+import constants
+
+import threading, time
+import numpy as np
+
+# Owns the keras-ocr Pipeline. TensorFlow is only imported on the loader thread,
+# so importing this module (and everything that imports it) stays cheap.
+class OcrModel(object):
+    def __init__(self):
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pipeline = None
+        self._error = None
+        self.load_time = None
+
+    # Safe to call any number of times, only the first call starts loading.
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._load, name='ocr-warmup', daemon=True)
+                self._thread.start()
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    # Blocks until the model is warm, checkpoint is polled so waiting jobs can still be cancelled.
+    def get(self, checkpoint=None):
+        self.start()
+        while not self._ready.wait(0.1):
+            if checkpoint is not None:
+                checkpoint()
+
+        if self._error is not None:
+            raise RuntimeError("Text detection model failed to load") from self._error
+        return self._pipeline
+
+    def clear_session(self):
+        if self._pipeline is None:
+            return
+        from keras import backend as K
+        K.clear_session()
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            concurrency.budget().apply_tensorflow()
+            from keras_ocr.pipeline import Pipeline
+
+            pipeline = Pipeline()
+            # First call traces the TF graph, do it now instead of on the user's first page.
+            warmup = np.full((constants.OCR_WARMUP_SIZE, constants.OCR_WARMUP_SIZE, 3), 255, dtype='uint8')
+            pipeline.recognize([warmup])
+            self._pipeline = pipeline
+        except BaseException as e:
+            self._error = e
+        finally:
+            self.load_time = time.perf_counter() - start
+            self._ready.set()
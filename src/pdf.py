@@ -0,0 +1,86 @@
+import constants
+
+import threading
+import cv2, numpy as np
+
+# Assembles a PDF straight from already encoded JPEG pages (DCTDecode), the same way PIL lays out its PDFs,
+# so a recompile only has to encode the pages that actually changed.
+
+class EncodedPage(object):
+    def __init__(self, data: bytes, width, height):
+        self.data = data
+        self.width = width
+        self.height = height
+
+def encode_page(final) -> EncodedPage:
+    ok, data = cv2.imencode('.jpg', final, [cv2.IMWRITE_JPEG_QUALITY, constants.EXPORT_JPEG_QUALITY])
+    if not ok:
+        raise ValueError("Could not encode page")
+    h, w = final.shape[:2]
+    return EncodedPage(data.tobytes(), w, h)
+
+# Anything that changes the rendered page has to be part of the key.
+def export_key(corners, mask_version, width) -> tuple:
+    return np.asarray(corners, dtype='float32').tobytes(), mask_version, width
+
+# Holds the encoded export of one page, render is only called when the key changed since last time.
+class ExportCache(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._page = None
+
+    def get(self, key, render) -> EncodedPage:
+        with self._lock:
+            if self._key == key:
+                return self._page
+
+        page = encode_page(render())
+        with self._lock:
+            self._key, self._page = key, page
+        return page
+
+def write_pdf(file, pages: list[EncodedPage], resolution=100.0):
+    objects = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(b'')
+    tree = add(b'')
+
+    kids = []
+    for page in pages:
+        image = add(b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB '
+                    b'/BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n'
+                    % (page.width, page.height, len(page.data)) + page.data + b'\nendstream')
+
+        w, h = page.width*72.0/resolution, page.height*72.0/resolution
+        content = b'q %.4f 0 0 %.4f 0 0 cm /image Do Q' % (w, h)
+        stream = add(b'<< /Length %d >>\nstream\n' % len(content) + content + b'\nendstream')
+
+        kids.append(add(b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.4f %.4f] '
+                        b'/Resources << /XObject << /image %d 0 R >> >> /Contents %d 0 R >>'
+                        % (tree, w, h, image, stream)))
+
+    objects[catalog - 1] = b'<< /Type /Catalog /Pages %d 0 R >>' % tree
+    objects[tree - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(b'%d 0 R' % k for k in kids), len(kids))
+
+    out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for id, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % id + body + b'\nendobj\n'
+
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, catalog, xref)
+
+    if isinstance(file, str):
+        with open(file, 'wb') as f:
+            f.write(out)
+    else:
+        file.write(out)
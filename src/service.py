@@ -0,0 +1,363 @@
+import concurrency
+concurrency.budget().apply_env()
+
+from detection import DocUtils
+from ocr import OcrModel
+from pdf import ExportCache, export_key, write_pdf
+import constants
+
+import argparse, io, itertools, json, os, queue, re, threading, time, traceback, uuid
+import cv2, numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Runs the detect/crop/mask/export pipeline behind a local HTTP API, so several operators share one warm model.
+#
+#   POST   /pages               body is an encoded image, returns {"id": ...} and queues detection + text mask
+#   GET    /pages/<id>          status, corners and timings of a page
+#   GET    /pages/<id>/mask     text mask as a PNG, once the page is done
+#   PUT    /pages/<id>/corners  {"corners": [[x, y], ...]} recrops with new corners, ahead of queued uploads
+#   DELETE /pages/<id>          forgets a page, pages idle for SERVICE_PAGE_EXPIRY are forgotten on their own
+#   POST   /compile             {"pages": [id, ...]} returns the compiled PDF
+#   GET    /stats               queue latency and throughput
+
+# PriorityQueue hands out the lowest value first.
+INTERACTIVE = 0
+BATCH       = 10
+
+class Job(object):
+    def __init__(self, fn, priority):
+        self.fn = fn
+        self.priority = priority
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class JobQueue(object):
+    def __init__(self, threads):
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+        self.start_time = time.perf_counter()
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_wait = 0.0
+
+        for id in range(threads):
+            threading.Thread(target=self._run, name=f'service-job-{id}', daemon=True).start()
+
+    def submit(self, fn, priority=BATCH) -> Job:
+        job = Job(fn, priority)
+        self._queue.put((priority, next(self._counter), job))
+        return job
+
+    def stats(self) -> dict:
+        with self._lock:
+            finished = self.completed + self.failed
+            elapsed = time.perf_counter() - self.start_time
+            return {
+                'queued': self._queue.qsize(),
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_queue_latency': self.total_wait/finished if finished else 0.0,
+                'max_queue_latency': self.max_wait,
+                'avg_run_time': self.total_run/finished if finished else 0.0,
+                'throughput': finished/elapsed if elapsed > 0 else 0.0,
+            }
+
+    def _run(self):
+        while True:
+            _, _, job = self._queue.get()
+            job.started = time.perf_counter()
+            try:
+                job.result = job.fn()
+            except Exception:
+                job.error = traceback.format_exc()
+            job.finished = time.perf_counter()
+
+            with self._lock:
+                if job.error is None:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                wait = job.started - job.submitted
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.total_run += job.finished - job.started
+            job.done.set()
+
+# Only the upload as it was sent is kept, each job decodes its own copy and drops it when done.
+class Page(object):
+    def __init__(self, data):
+        self.data = data
+        self.corners = None
+        self.mask = None
+        self.mask_version = 0
+        self.export_cache = ExportCache()
+        self.job: Job = None
+        self.touched = time.monotonic()
+        self.removed = False
+        # corners, mask and mask_version only change together under this lock, see snapshot().
+        self.lock = threading.Lock()
+
+    @property
+    def orig(self):
+        return DocUtils.decode_image(self.data)
+
+    # What a compile renders, fixed when the compile is asked for, so corners set while it waits
+    # only apply to later compiles.
+    def snapshot(self) -> tuple:
+        with self.lock:
+            return self.corners, self.mask, self.mask_version
+
+    def status(self) -> str:
+        if self.job.error is not None:
+            return 'error'
+        if self.job.done.is_set():
+            return 'done'
+        return 'running' if self.job.started is not None else 'queued'
+
+    def info(self, id) -> dict:
+        info = {'id': id, 'status': self.status()}
+        if self.corners is not None:
+            info['corners'] = np.asarray(self.corners).tolist()
+        if self.job.started is not None:
+            info['queue_latency'] = self.job.started - self.job.submitted
+        if self.job.finished is not None:
+            info['run_time'] = self.job.finished - self.job.started
+        if self.job.error is not None:
+            info['error'] = self.job.error
+        return info
+
+class ServiceError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+class Service(object):
+    def __init__(self, threads=None):
+        self.model = OcrModel()
+        self.model.start()
+        self.queue = JobQueue(threads or concurrency.budget().jobs)
+
+        self._pages: dict[str, Page] = {}
+        self._pages_lock = threading.Lock()
+        # Keras models are not safe to call from several threads at once.
+        self._ocr_lock = threading.Lock()
+
+    def add_page(self, data: bytes) -> str:
+        # A reduced grayscale decode is enough to reject a bad upload, the page itself is decoded by its job.
+        if cv2.imdecode(np.frombuffer(data, dtype='uint8'), cv2.IMREAD_REDUCED_GRAYSCALE_8) is None:
+            raise ServiceError(400, "Could not decode image")
+
+        id = uuid.uuid4().hex
+        page = Page(data)
+        page.job = self.queue.submit(lambda: self._process(page), BATCH)
+        with self._pages_lock:
+            self._expire()
+            self._pages[id] = page
+        return id
+
+    def set_corners(self, id, corners):
+        page = self.page(id)
+        if np.asarray(corners).shape != (4, 2):
+            raise ServiceError(400, "Expected four [x, y] corners")
+        if not page.job.done.is_set():
+            raise ServiceError(409, "Page is still processing")
+
+        corners = np.asarray(corners, dtype='float32')
+        page.job = self.queue.submit(lambda: self._process(page, corners), INTERACTIVE)
+
+    def remove_page(self, id):
+        with self._pages_lock:
+            page = self._pages.pop(id, None)
+        if page is None:
+            raise ServiceError(404, "No such page")
+        page.removed = True
+
+    def page(self, id) -> Page:
+        with self._pages_lock:
+            self._expire()
+            page = self._pages.get(id)
+        if page is None:
+            raise ServiceError(404, "No such page")
+        page.touched = time.monotonic()
+        return page
+
+    # Called with _pages_lock held. Pages still waiting on a job are kept, however long the queue is.
+    def _expire(self):
+        now = time.monotonic()
+        for id, page in list(self._pages.items()):
+            if page.job.done.is_set() and now - page.touched > constants.SERVICE_PAGE_EXPIRY:
+                del self._pages[id]
+                page.removed = True
+
+    def mask_png(self, id) -> bytes:
+        page = self.done_page(id)
+        return cv2.imencode('.png', page.mask)[1].tobytes()
+
+    def done_page(self, id) -> Page:
+        page = self.page(id)
+        match page.status():
+            case 'done':
+                return page
+            case 'error':
+                raise ServiceError(500, page.job.error)
+            case _:
+                raise ServiceError(409, "Page is still processing")
+
+    def compile(self, ids, width=None) -> bytes:
+        pages = [self.done_page(id) for id in ids]
+        if len(pages) == 0:
+            raise ServiceError(400, "No pages to compile")
+        pages = [(page, page.snapshot()) for page in pages]
+
+        job = self.queue.submit(lambda: self._export(pages, width or constants.SAVE_WIDTH), BATCH)
+        job.done.wait()
+        if job.error is not None:
+            raise ServiceError(500, job.error)
+        return job.result
+
+    # Jobs of a page removed while they were queued are skipped. Corners are found when none are given.
+    def _process(self, page: Page, corners=None):
+        if page.removed:
+            return
+
+        orig = page.orig
+        if corners is None:
+            _, corners = DocUtils.find_document(orig)
+        crop = DocUtils.crop_document(orig, corners)
+        del orig
+
+        pipeline = self.model.get()
+        with self._ocr_lock:
+            mask = DocUtils.text_mask(crop, pipeline)
+        with page.lock:
+            page.corners, page.mask = corners, mask
+            page.mask_version += 1
+
+    # Unchanged pages reuse their encoding from the previous compile.
+    def _export(self, pages, width) -> bytes:
+        encoded = []
+        for page, (corners, mask, mask_version) in pages:
+            def render(page=page, corners=corners, mask=mask):
+                crop = DocUtils.crop_document(page.orig, corners)
+                return DocUtils.resized_final(crop, mask, width=width)
+            encoded.append(page.export_cache.get(export_key(corners, mask_version, width), render))
+
+        out = io.BytesIO()
+        write_pdf(out, encoded, resolution=100.0)
+        return out.getvalue()
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    service: Service = None
+
+    routes = [
+        ('POST',   re.compile(r'^/pages$'),                   'post_page'),
+        ('GET',    re.compile(r'^/pages/(\w+)$'),             'get_page'),
+        ('GET',    re.compile(r'^/pages/(\w+)/mask$'),        'get_mask'),
+        ('PUT',    re.compile(r'^/pages/(\w+)/corners$'),     'put_corners'),
+        ('DELETE', re.compile(r'^/pages/(\w+)$'),             'delete_page'),
+        ('POST',   re.compile(r'^/compile$'),                 'post_compile'),
+        ('GET',    re.compile(r'^/stats$'),                   'get_stats'),
+    ]
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+    def post_page(self):
+        self._send_json({'id': self.service.add_page(self._body())}, 202)
+
+    def get_page(self, id):
+        self._send_json(self.service.page(id).info(id))
+
+    def get_mask(self, id):
+        self._send(self.service.mask_png(id), 'image/png')
+
+    def put_corners(self, id):
+        self.service.set_corners(id, self._json().get('corners'))
+        self._send_json({'id': id}, 202)
+
+    def delete_page(self, id):
+        self.service.remove_page(id)
+        self._send_json({'id': id})
+
+    def post_compile(self):
+        request = self._json()
+        self._send(self.service.compile(request.get('pages', []), request.get('width')), 'application/pdf')
+
+    def get_stats(self):
+        self._send_json(self.service.queue.stats())
+
+    def _dispatch(self, method):
+        path = self.path.split('?')[0]
+        try:
+            for route_method, pattern, name in self.routes:
+                match = pattern.match(path)
+                if route_method == method and match:
+                    getattr(self, name)(*match.groups())
+                    return
+            raise ServiceError(404, "Not found")
+        except ServiceError as e:
+            self._send_json({'error': str(e)}, e.code)
+        except Exception:
+            self._send_json({'error': traceback.format_exc()}, 500)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _json(self) -> dict:
+        try:
+            return json.loads(self._body() or b'{}')
+        except json.JSONDecodeError:
+            raise ServiceError(400, "Invalid JSON body")
+
+    def _send_json(self, data, code=200):
+        self._send(json.dumps(data).encode(), 'application/json', code)
+
+    def _send(self, data: bytes, content_type, code=200):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def make_server(host, port, service: Service) -> ThreadingHTTPServer:
+    handler = type('BoundServiceHandler', (ServiceHandler,), {'service': service})
+    return ThreadingHTTPServer((host, port), handler)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the page pipeline over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1', help="use 0.0.0.0 to serve the whole LAN")
+    parser.add_argument('--port', type=int, default=constants.SERVICE_PORT)
+    parser.add_argument('--threads', type=int, default=None, help="concurrent jobs, defaults to the thread budget")
+    args = parser.parse_args()
+
+    if os.path.exists(constants.PROFILE_PATH):
+        print(f"Loaded profile: {constants.load_profile()}", flush=True)
+    concurrency.budget().apply_opencv()
+    print(f"Thread budget: {concurrency.budget()}", flush=True)
+
+    server = make_server(args.host, args.port, Service(args.threads))
+    print(f"Serving on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,106 @@
+import constants
+
+import os, re, zipfile
+import cv2, numpy as np
+from PIL import Image
+
+# Lazy page input. Opening a file only reads enough to count its pages, each page is decoded when load() is called,
+# so a 400 page TIFF or archive costs one page of memory at a time.
+
+class PageSource(object):
+    def __init__(self, name, loader, reader=None):
+        self.name = name
+        self._loader = loader
+        self._reader = reader
+
+    def load(self) -> np.ndarray:
+        image = self._loader()
+        if image is None:
+            raise ValueError(f"Could not decode {self.name}")
+        return image
+
+    # The page as an encoded image, straight from the file when it already is one, otherwise as a PNG.
+    def read(self) -> bytes:
+        if self._reader is not None:
+            return self._reader()
+        return cv2.imencode('.png', self.load())[1].tobytes()
+
+def read_file(path) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def natural_key(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+def extension(path) -> str:
+    return os.path.splitext(path)[1][1:].lower()
+
+def image_file(path) -> list[PageSource]:
+    return [PageSource(os.path.basename(path), lambda: cv2.imread(path), lambda: read_file(path))]
+
+# Every frame of a (multi-page) TIFF, reopened per page so no decoded frame is kept around.
+def tiff_file(path) -> list[PageSource]:
+    with Image.open(path) as image:
+        count = getattr(image, 'n_frames', 1)
+
+    def loader(frame):
+        def load():
+            with Image.open(path) as image:
+                image.seek(frame)
+                return cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+        return load
+
+    name = os.path.basename(path)
+    return [PageSource(f"{name} #{frame+1}", loader(frame)) for frame in range(count)]
+
+# Images inside a ZIP or CBZ, in natural name order.
+def archive_file(path) -> list[PageSource]:
+    with zipfile.ZipFile(path) as archive:
+        members = [m for m in archive.namelist() if not m.endswith('/') and extension(m) in constants.IMAGE_FILES]
+    members.sort(key=natural_key)
+
+    def reader(member):
+        def read():
+            with zipfile.ZipFile(path) as archive:
+                return archive.read(member)
+        return read
+
+    def loader(member):
+        return lambda: cv2.imdecode(np.frombuffer(reader(member)(), dtype='uint8'), cv2.IMREAD_COLOR)
+
+    name = os.path.basename(path)
+    return [PageSource(f"{name}/{member}", loader(member), reader(member)) for member in members]
+
+# PDF pages are rendered at PDF_RENDER_DPI, this needs the optional PyMuPDF package.
+def pdf_file(path) -> list[PageSource]:
+    try:
+        import fitz
+    except ImportError:
+        raise ImportError("Opening PDFs needs PyMuPDF, install it with 'pip install pymupdf'")
+
+    with fitz.open(path) as document:
+        count = document.page_count
+
+    def loader(number):
+        def load():
+            with fitz.open(path) as document:
+                pixmap = document[number].get_pixmap(dpi=constants.PDF_RENDER_DPI, colorspace=fitz.csRGB, alpha=False)
+                image = np.frombuffer(pixmap.samples, dtype='uint8').reshape(pixmap.height, pixmap.width, 3)
+                return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        return load
+
+    name = os.path.basename(path)
+    return [PageSource(f"{name} #{number+1}", loader(number)) for number in range(count)]
+
+OPENERS = {
+    'tif': tiff_file, 'tiff': tiff_file,
+    'zip': archive_file, 'cbz': archive_file,
+    'pdf': pdf_file,
+}
+
+# Pages of every given file in order, a container expands into its pages.
+def open_pages(paths) -> list[PageSource]:
+    pages = []
+    for path in paths:
+        pages += OPENERS.get(extension(path), image_file)(path)
+    return pages
@@ -0,0 +1,96 @@
+import concurrency
+import constants
+
+import tempfile, threading
+import cv2, numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Set on the threads of a page_pool(), whose pages already use up the tile threads between them.
+_page_threads = threading.local()
+
+def _mark_page_thread():
+    _page_threads.active = True
+
+# Strip based versions of the full frame operations in DocUtils.
+# Large scans are processed a band of output rows at a time, so peak memory follows TILE_HEIGHT instead of the page size.
+class TileUtils:
+    def is_large(shape) -> bool:
+        return shape[0]*shape[1] >= constants.TILE_PIXELS
+
+    # Very large outputs are backed by a temporary file instead of RAM.
+    def allocate(shape, dtype='uint8', zero=False) -> np.ndarray:
+        if shape[0]*shape[1] >= constants.TILE_MEMMAP_PIXELS:
+            return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+        return np.zeros(shape, dtype=dtype) if zero else np.empty(shape, dtype=dtype)
+
+    def strips(height) -> list[tuple[int, int]]:
+        return [(y, min(y + constants.TILE_HEIGHT, height)) for y in range(0, height, constants.TILE_HEIGHT)]
+
+    # Runs whole pages side by side on the tile threads.
+    def page_pool() -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(concurrency.budget().tiles, initializer=_mark_page_thread)
+
+    # Strips write to disjoint rows of the output, and OpenCV drops the GIL, so they run in parallel threads.
+    # Inside a page_pool() they run one after another instead, so the two levels don't multiply the threads.
+    def run_strips(fn, height, checkpoint=None):
+        checkpoint = checkpoint or (lambda: None)
+
+        def run(strip):
+            checkpoint()
+            fn(*strip)
+
+        if getattr(_page_threads, 'active', False):
+            for strip in TileUtils.strips(height):
+                run(strip)
+            return
+
+        with ThreadPoolExecutor(concurrency.budget().tiles) as pool:
+            list(pool.map(run, TileUtils.strips(height)))
+
+    # Same result as cv2.warpPerspective(img, matrix, size), only reading the source region each strip maps from.
+    def warp_perspective(img, matrix, size, checkpoint=None) -> np.ndarray:
+        width, height = size
+        out = TileUtils.allocate((height, width) + img.shape[2:], img.dtype)
+        inverse = np.linalg.inv(matrix)
+
+        def warp_strip(y0, y1):
+            dst = np.array([[[0, y0], [width, y0], [0, y1], [width, y1]]], dtype='float32')
+            src = cv2.perspectiveTransform(dst, inverse)[0]
+
+            # Pad by a few pixels so interpolation at the region edge still has its neighbours.
+            x_min = int(max(0, np.floor(src[:,0].min()) - 2))
+            y_min = int(max(0, np.floor(src[:,1].min()) - 2))
+            x_max = int(min(img.shape[1], np.ceil(src[:,0].max()) + 3))
+            y_max = int(min(img.shape[0], np.ceil(src[:,1].max()) + 3))
+
+            if x_min >= x_max or y_min >= y_max:
+                out[y0:y1] = 0
+                return
+
+            shift_src = np.array([[1, 0, x_min], [0, 1, y_min], [0, 0, 1]], dtype='float64')
+            shift_dst = np.array([[1, 0, 0], [0, 1, -y0], [0, 0, 1]], dtype='float64')
+            local = shift_dst @ matrix @ shift_src
+
+            out[y0:y1] = cv2.warpPerspective(img[y_min:y_max, x_min:x_max], local, (width, y1 - y0))
+
+        TileUtils.run_strips(warp_strip, height, checkpoint)
+        return out
+
+    # Inpaints each strip with TILE_OVERLAP rows of context on both sides and keeps only the core rows.
+    def inpaint(img, mask, radius, flags, checkpoint=None) -> np.ndarray:
+        height = img.shape[0]
+        out = TileUtils.allocate(img.shape, img.dtype)
+
+        def inpaint_strip(y0, y1):
+            top = max(0, y0 - constants.TILE_OVERLAP)
+            bottom = min(height, y1 + constants.TILE_OVERLAP)
+
+            if not mask[top:bottom].any():
+                out[y0:y1] = img[y0:y1]
+                return
+
+            region = cv2.inpaint(np.ascontiguousarray(img[top:bottom]), np.ascontiguousarray(mask[top:bottom]), radius, flags)
+            out[y0:y1] = region[y0 - top:y1 - top]
+
+        TileUtils.run_strips(inpaint_strip, height, checkpoint)
+        return out
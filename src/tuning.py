@@ -0,0 +1,239 @@
+import concurrency
+concurrency.budget().apply_env()
+
+from detection import DocUtils
+import constants
+
+import argparse, itertools, json, math, os, random, string, time
+import cv2, numpy as np
+
+# Sweeps the detection constants over an annotated corpus and recommends the fastest profile that keeps the corners.
+#
+# The corpus is the bundled imaging/*.jpg, hand annotated in imaging/corners.json (to about 20px),
+# plus synthetic pages with exact corners. With --ocr the text mask settings are swept as well, scored
+# against the mask the current settings produce, since there is no ground truth for text.
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+ANNOTATIONS = os.path.join(SRC_DIR, 'imaging', 'corners.json')
+
+DETECTION_GRID = {
+    'ANALYSIS_HEIGHT':  [400, 500, 600, 800],
+    'HOUGH_THRESH':     [40, 60, 80],
+    'CANNY_SIGMA':      [0.25, 0.33, 0.4, 0.5],
+    'RHO_THRESH':       [15, 25, 40],
+    'THETA_THRESH':     [math.pi/120, math.pi/90, math.pi/60],
+    'LINE_THRESH':      [4*math.pi/45, 5*math.pi/45, 6*math.pi/45],
+    'EDGE_CHANNEL':     ['luma', 'contrast', 'color'],
+}
+
+OCR_GRID = {
+    'OCR_GLYPH_TARGET': [9, 10, 12, 14],
+    'OCR_HEIGHT':       [960, 1200],
+    'OCR_TILED':        [True, False],
+}
+
+class Sample(object):
+    def __init__(self, name, image, corners):
+        self.name = name
+        self.image = image
+        self.corners = DocUtils.order_point(np.asarray(corners, dtype='float32'))
+        self.diagonal = float(np.hypot(*image.shape[:2]))
+
+def load_corpus(synthetic, seed) -> list[Sample]:
+    samples = []
+    with open(ANNOTATIONS) as f:
+        for name, corners in json.load(f).items():
+            samples.append(Sample(name, cv2.imread(os.path.join(SRC_DIR, 'imaging', name)), corners))
+
+    rng = random.Random(seed)
+    for id in range(synthetic):
+        image, corners = synthetic_page(rng)
+        samples.append(Sample(f"synthetic-{id}", image, corners))
+    return samples
+
+# A letter sized page with lines of text, put in perspective on a dark textured table.
+def synthetic_page(rng: random.Random, size=(1536, 2048)):
+    w, h = size
+    page_w = rng.randint(int(w*0.55), int(w*0.8))
+    page_h = int(page_w*constants.RATIO_BASE)
+
+    page = np.full((page_h, page_w, 3), rng.randint(200, 245), dtype='uint8')
+    y = rng.randint(40, 90)
+    while y < page_h - 40:
+        words = ' '.join(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 8))) for _ in range(12))
+        cv2.putText(page, words, (30, y), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (40, 40, 40), 2, cv2.LINE_AA)
+        y += rng.randint(30, 60)
+
+    table = np.full((h, w, 3), 0, dtype='uint8')
+    table[:] = (rng.randint(20, 90), rng.randint(20, 80), rng.randint(20, 70))
+    for _ in range(200):
+        y0 = rng.randint(0, h)
+        shade = tuple(int(c) + rng.randint(-15, 15) for c in table[0, 0])
+        cv2.line(table, (0, y0), (w, y0 + rng.randint(-60, 60)), shade, rng.randint(1, 6))
+
+    # Jitter each corner of a centred page to get a perspective view.
+    x0, y0 = (w - page_w)//2, (h - page_h)//2
+    jitter = lambda: rng.randint(-int(w*0.06), int(w*0.06))
+    corners = np.array([
+        [x0 + jitter(), y0 + jitter()],
+        [x0 + page_w + jitter(), y0 + jitter()],
+        [x0 + page_w + jitter(), y0 + page_h + jitter()],
+        [x0 + jitter(), y0 + page_h + jitter()]], dtype='float32')
+    corners = np.clip(corners, 5, [w - 5, h - 5]).astype('float32')
+
+    src = np.array([[0, 0], [page_w, 0], [page_w, page_h], [0, page_h]], dtype='float32')
+    matrix = cv2.getPerspectiveTransform(src, corners)
+    warped = cv2.warpPerspective(page, matrix, (w, h))
+    cover = cv2.warpPerspective(np.full((page_h, page_w), 255, dtype='uint8'), matrix, (w, h))
+    table[cover > 0] = warped[cover > 0]
+
+    noise = np.random.default_rng(rng.randint(0, 2**32 - 1)).normal(0, 6, table.shape)
+    image = cv2.GaussianBlur(np.clip(table + noise, 0, 255).astype('uint8'), (3, 3), 0)
+    return image, corners
+
+# Mean distance between matching corners, as a percentage of the image diagonal.
+def corner_error(sample: Sample, corners) -> float:
+    found = DocUtils.order_point(np.asarray(corners, dtype='float32'))
+    return float(np.linalg.norm(found - sample.corners, axis=1).mean())/sample.diagonal*100
+
+def mask_iou(a, b) -> float:
+    a, b = a > 0, b > 0
+    union = np.count_nonzero(a | b)
+    return 1.0 if union == 0 else np.count_nonzero(a & b)/union
+
+def configs(grid, samples, rng) -> list[dict]:
+    names = list(grid)
+    every = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    if samples is not None and samples < len(every):
+        every = rng.sample(every, samples)
+    # The current settings are always measured, they are the baseline for the recommendation.
+    return [{name: getattr(constants, name) for name in names}] + every
+
+def apply(config):
+    for name, value in config.items():
+        setattr(constants, name, value)
+
+def run_detection(corpus, config, repeat) -> dict:
+    apply(config)
+    errors, find_times, crop_times = [], [], []
+    for sample in corpus:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            _, corners = DocUtils.find_document(sample.image)
+            find_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            DocUtils.crop_document(sample.image, corners)
+            crop_times.append(time.perf_counter() - start)
+        errors.append(corner_error(sample, corners))
+
+    return {
+        'config': config,
+        'error': float(np.mean(errors)),
+        'max_error': float(np.max(errors)),
+        'time': float(np.mean(find_times)),
+        'stages': {'find_document': float(np.mean(find_times)), 'crop_document': float(np.mean(crop_times))},
+    }
+
+# Crops come from the ground truth corners, so only the text mask settings vary.
+def run_ocr(crops, references, pipeline, config, repeat) -> dict:
+    apply(config)
+    scores, times = [], []
+    for crop, reference in zip(crops, references):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            mask = DocUtils.text_mask(crop, pipeline)
+            times.append(time.perf_counter() - start)
+        scores.append(mask_iou(mask, reference))
+
+    # Lower is better for the front, so accuracy is stored as a loss.
+    return {
+        'config': config,
+        'error': 1.0 - float(np.mean(scores)),
+        'time': float(np.mean(times)),
+        'stages': {'text_mask': float(np.mean(times))},
+    }
+
+# Results no other result beats on both error and time, fastest first.
+def pareto_front(results) -> list[dict]:
+    front = []
+    for result in sorted(results, key=lambda r: (r['time'], r['error'])):
+        if len(front) == 0 or result['error'] < front[-1]['error']:
+            front.append(result)
+    return front
+
+def recommend(front, baseline, tolerance) -> dict:
+    allowed = [r for r in front if r['error'] <= baseline['error'] + tolerance]
+    return allowed[0] if len(allowed) > 0 else min(front, key=lambda r: r['error'])
+
+def sweep(name, grid, run, samples, rng, tolerance) -> tuple[dict, dict]:
+    defaults = {key: getattr(constants, key) for key in grid}
+    results = []
+    try:
+        for id, config in enumerate(configs(grid, samples, rng)):
+            results.append(run(config))
+            print(f"{name} {id+1:>4}  error {results[-1]['error']:7.3f}  time {results[-1]['time']*1000:8.1f}ms  {config}", flush=True)
+    finally:
+        apply(defaults)
+
+    front = pareto_front(results)
+    best = recommend(front, results[0], tolerance)
+    print(f"\n{name} pareto front:")
+    for result in front:
+        print(f"  error {result['error']:7.3f}  time {result['time']*1000:8.1f}ms  {result['config']}")
+    print(f"{name} baseline:    error {results[0]['error']:7.3f}  time {results[0]['time']*1000:8.1f}ms")
+    print(f"{name} recommended: error {best['error']:7.3f}  time {best['time']*1000:8.1f}ms\n")
+    return {'results': results, 'front': front, 'recommended': best}, best['config']
+
+# Overrides only touch the grid that sweeps that constant.
+def parse_grid(grid, overrides) -> dict:
+    grid = dict(grid)
+    for override in overrides:
+        name, values = override.split('=', 1)
+        if name not in DETECTION_GRID and name not in OCR_GRID:
+            raise SystemExit(f"{name} is not a tunable constant")
+        if name in grid:
+            grid[name] = [json.loads(v) for v in values.split(',')]
+    return grid
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the fastest detection settings that still find the corners.")
+    parser.add_argument('--synthetic', type=int, default=12, help="synthetic pages added to the corpus")
+    parser.add_argument('--samples', type=int, default=60, help="random configs per sweep, all of them if omitted with 0")
+    parser.add_argument('--repeat', type=int, default=1, help="timed runs per page")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed extra corner error, in percent of the diagonal")
+    parser.add_argument('--grid', action='append', default=[], metavar='NAME=V1,V2', help="replace the values swept for one constant")
+    parser.add_argument('--ocr', action='store_true', help="also sweep the text mask settings, needs the model")
+    parser.add_argument('--ocr-tolerance', type=float, default=0.05, help="allowed loss of mask IoU")
+    parser.add_argument('--out', default='tuning_results.json')
+    parser.add_argument('--profile', default=constants.PROFILE_PATH, help="where the recommended profile is written")
+    args = parser.parse_args()
+
+    concurrency.budget().apply_opencv()
+    print(f"Thread budget: {concurrency.budget()}")
+
+    rng = random.Random(args.seed)
+    corpus = load_corpus(args.synthetic, args.seed)
+    samples = args.samples or None
+
+    report, profile = {}, {}
+    report['detection'], chosen = sweep('detection', parse_grid(DETECTION_GRID, args.grid),
+        lambda config: run_detection(corpus, config, args.repeat), samples, rng, args.tolerance)
+    profile.update(chosen)
+
+    if args.ocr:
+        from ocr import OcrModel
+        pipeline = OcrModel().get()
+
+        crops = [DocUtils.crop_document(sample.image, sample.corners) for sample in corpus]
+        references = [DocUtils.text_mask(crop, pipeline) for crop in crops]
+        report['ocr'], chosen = sweep('ocr', parse_grid(OCR_GRID, args.grid),
+            lambda config: run_ocr(crops, references, pipeline, config, args.repeat), samples, rng, args.ocr_tolerance)
+        profile.update(chosen)
+
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=4)
+    with open(args.profile, 'w') as f:
+        json.dump(profile, f, indent=4)
+    print(f"Results written to {args.out}, recommended profile written to {args.profile}")
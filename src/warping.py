@@ -0,0 +1,101 @@
+import constants
+
+import threading
+import cv2, numpy as np
+
+# Perspective warps for books shot on a fixed rig, where one page's corners land within a few pixels of the last.
+#
+# The first page with a given geometry is warped as usual and remembered. Once a second page matches it,
+# the warp's source coordinates are computed once into a fixed point cv2.remap map pair, and every
+# matching page after that is a plain remap. Books shot by hand never match, so they never pay for the maps.
+#
+# Moving a corner by REMAP_TOLERANCE changes the output size by up to twice that, so the maps are built
+# that much larger and each page takes the top left of them at its own size.
+
+class RemapEntry(object):
+    def __init__(self, rect, shape, matrix, size):
+        self.rect = rect
+        self.shape = shape
+        self.matrix = matrix
+        pad = int(np.ceil(2*constants.REMAP_TOLERANCE))
+        self.size = (size[0] + pad, size[1] + pad)
+        self.maps = None
+        self.lock = threading.Lock()
+
+    # The output size is always the one the page's own corners give, so a page crops to the same size
+    # whatever else is cached, and its mask keeps fitting when it is cropped again.
+    def matches(self, rect, shape, size) -> bool:
+        return (shape == self.shape and size[0] <= self.size[0] and size[1] <= self.size[1]
+                and float(np.abs(rect - self.rect).max()) <= constants.REMAP_TOLERANCE)
+
+    # Both maps together, CV_16SC2 and CV_16UC1.
+    def nbytes(self) -> int:
+        return self.size[0]*self.size[1]*6
+
+    # The source coordinates of every output pixel, in remap's fixed point format (CV_16SC2). Rounding differs
+    # slightly from warpPerspective's own, a few pixels in a hundred come out a level or two apart.
+    def build_maps(self):
+        with self.lock:
+            if self.maps is not None:
+                return self.maps
+
+            width, height = self.size
+            inverse = np.linalg.inv(self.matrix).astype('float32')
+            xs = np.arange(width, dtype='float32')[None, :]
+            ys = np.arange(height, dtype='float32')[:, None]
+            w = inverse[2, 0]*xs + (inverse[2, 1]*ys + inverse[2, 2])
+            map_x = (inverse[0, 0]*xs + (inverse[0, 1]*ys + inverse[0, 2]))/w
+            map_y = (inverse[1, 0]*xs + (inverse[1, 1]*ys + inverse[1, 2]))/w
+            self.maps = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+            return self.maps
+
+class RemapCache(object):
+    def __init__(self):
+        self._entries: list[RemapEntry] = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # rect is ordered tl, tr, br, bl and matrix maps it onto an output of size (width, height).
+    # A page matching a remembered one is warped with that page's corners, off by at most REMAP_TOLERANCE pixels.
+    def warp(self, img, rect, matrix, size) -> np.ndarray:
+        shape = img.shape[:2]
+        with self._lock:
+            entry = next((entry for entry in self._entries if entry.matches(rect, shape, size)), None)
+            if entry is None:
+                self.misses += 1
+                self._entries.insert(0, RemapEntry(rect, shape, matrix, size))
+                del self._entries[constants.REMAP_CACHE_SIZE:]
+            else:
+                self.hits += 1
+                self._entries.remove(entry)
+                self._entries.insert(0, entry)
+
+        if entry is None or entry.nbytes() > constants.REMAP_CACHE_BYTES:
+            return cv2.warpPerspective(img, matrix, size)
+        map1, map2 = entry.build_maps()
+        self._trim(entry)
+
+        width, height = size
+        return cv2.remap(img, map1[:height, :width], map2[:height, :width], cv2.INTER_LINEAR)
+
+    # Drops the least recently used entries until the built maps fit in REMAP_CACHE_BYTES again.
+    # A thread still warping with a dropped entry keeps its own reference to the maps.
+    def _trim(self, keep):
+        with self._lock:
+            while sum(entry.nbytes() for entry in self._entries if entry.maps is not None) > constants.REMAP_CACHE_BYTES:
+                evicted = next(entry for entry in reversed(self._entries) if entry.maps is not None and entry is not keep)
+                self._entries.remove(evicted)
+
+    # Called when a batch ends, the maps only pay off between pages of the same book.
+    def clear(self):
+        with self._lock:
+            self._entries = []
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'bytes': sum(entry.nbytes() for entry in self._entries if entry.maps is not None)}
+
+remaps = RemapCache()